@@ -0,0 +1,68 @@
+import torch
+
+
+class AssistedGenerator:
+    """Drop-in replacement for the text-generation pipeline that decodes with a small
+    draft model proposing tokens for the main model to verify (assisted decoding).
+
+    Decoding is greedy, so the output is the main model's own greedy output. The
+    draft must share the main model's tokenizer. Assisted generation handles one
+    prompt at a time.
+
+    Acceptance is counted with forward hooks: every main model forward verifies one
+    batch of draft tokens and yields one token of its own, so the accepted draft
+    tokens are the new tokens minus the main model forwards.
+    """
+
+    def __init__(self, model, tokenizer, draft_model):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.draft_model = draft_model
+        self.forwards = {"main": 0, "draft": 0}
+        model.register_forward_hook(self._counter("main"))
+        draft_model.register_forward_hook(self._counter("draft"))
+        self.drafted_tokens = 0
+        self.accepted_tokens = 0
+        self.last_call = {}
+
+    def _counter(self, name):
+        def hook(module, inputs, output):
+            self.forwards[name] += 1
+        return hook
+
+    def __call__(self, messages, max_new_tokens: int = 128, pad_token_id: int = None, **kwargs):
+        # Accepts the pipeline's batched chat call; decoding is always greedy
+        drafted, accepted = self.drafted_tokens, self.accepted_tokens
+        outputs = []
+        for conversation in messages:
+            text = self.generate(conversation, max_new_tokens, pad_token_id)
+            outputs.append([{"generated_text": conversation + [{"role": "assistant", "content": text}]}])
+        self.last_call = {"draft_tokens": self.drafted_tokens - drafted,
+                          "accepted_draft_tokens": self.accepted_tokens - accepted}
+        return outputs
+
+    @torch.no_grad()
+    def generate(self, conversation, max_new_tokens: int = 128, pad_token_id: int = None) -> str:
+        text = self.tokenizer.apply_chat_template(conversation, tokenize=False, add_generation_prompt=True)
+        input_ids = self.tokenizer(text, return_tensors="pt", add_special_tokens=False).input_ids.to(self.model.device)
+        self.forwards.update(main=0, draft=0)
+        output = self.model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            assistant_model=self.draft_model,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            top_p=None,
+            pad_token_id=pad_token_id)
+        new_tokens = output.shape[1] - input_ids.shape[1]
+        self.drafted_tokens += self.forwards["draft"]
+        self.accepted_tokens += max(0, new_tokens - self.forwards["main"])
+        return self.tokenizer.decode(output[0, input_ids.shape[1]:], skip_special_tokens=True)
+
+    def trace_fields(self) -> dict:
+        return self.last_call
+
+    def stats(self) -> str:
+        rate = self.accepted_tokens / self.drafted_tokens if self.drafted_tokens else 0.0
+        return (f"Assisted decoding: {self.accepted_tokens} of {self.drafted_tokens} draft tokens accepted "
+                f"({rate:.1%} acceptance rate)")
@@ -0,0 +1,227 @@
+import contextlib
+import hashlib
+import http.client
+import json
+import queue
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+
+class Backend:
+    """Interface the debate calls the LLM through.
+
+    `generate` maps a list of user prompts to their greedy completions, in order.
+    """
+
+    model_name = None
+
+    def generate(self, prompts: List[str], max_new_tokens: int = 128) -> List[str]:
+        raise NotImplementedError
+
+    def count_tokens(self, prompts: List[str]) -> int:
+        # Approximation for backends without a local tokenizer
+        return sum(len(prompt.split()) for prompt in prompts)
+
+    def stats(self) -> str:
+        return ""
+
+    def trace_fields(self) -> dict:
+        # Backend-specific metrics of the last generate call, added to its trace event
+        return {}
+
+    def close(self):
+        pass
+
+
+class HFBackend(Backend):
+    """In-process transformers generation through a text-generation pipeline (or a
+    drop-in such as PrefixCachingGenerator). `autocast` optionally returns a
+    context manager each generate call runs under, e.g. CPU bf16 autocast."""
+
+    def __init__(self, generator, batch_size: int = None, autocast=None, model_name: str = None):
+        self.generator = generator
+        self.tokenizer = generator.tokenizer
+        self.model_name = model_name or generator.model.name_or_path
+        self.batch_size = batch_size
+        self.autocast = autocast or contextlib.nullcontext
+        self.generated_tokens = 0
+        self.generate_seconds = 0.0
+
+    def generate(self, prompts: List[str], max_new_tokens: int = 128) -> List[str]:
+        # Greedy decoding over left-padded batches; the tokenizer's padding side and
+        # pad token are configured at load time so every row matches the
+        # single-prompt path. Longest prompts go first so each batch pads rows of
+        # similar length.
+        if not prompts:
+            return []
+        order = sorted(range(len(prompts)), key=lambda k: len(prompts[k]), reverse=True)
+        width = self.batch_size or len(prompts)
+        outputs = [None] * len(prompts)
+        started = time.perf_counter()
+        for start in range(0, len(order), width):
+            chunk = order[start:start + width]
+            messages = [[{"role": "user", "content": prompts[k]}] for k in chunk]
+            with self.autocast():
+                results = self.generator(
+                            messages,
+                            max_new_tokens=max_new_tokens,
+                            top_p=None,
+                            do_sample=False,
+                            batch_size=width,
+                            pad_token_id=self.tokenizer.pad_token_id)
+            for k, result in zip(chunk, results):
+                outputs[k] = result[0]["generated_text"][-1]['content'].strip()
+        self.generate_seconds += time.perf_counter() - started
+        self.generated_tokens += self.count_tokens(outputs)
+        return outputs
+
+    def count_tokens(self, prompts: List[str]) -> int:
+        if not prompts:
+            return 0
+        return sum(len(ids) for ids in self.tokenizer(prompts, add_special_tokens=False)["input_ids"])
+
+    def stats(self) -> str:
+        rate = self.generated_tokens / self.generate_seconds if self.generate_seconds else 0.0
+        lines = [f"Generation: {self.generated_tokens} tokens in {self.generate_seconds:.1f}s ({rate:.1f} tokens/s)"]
+        if hasattr(self.generator, "stats"):
+            lines.append(self.generator.stats())
+        return "\n".join(lines)
+
+    def trace_fields(self) -> dict:
+        return self.generator.trace_fields() if hasattr(self.generator, "trace_fields") else {}
+
+
+class OpenAIServerBackend(Backend):
+    """Client for a local OpenAI-compatible chat completions server (vLLM, TGI,
+    llama.cpp, ...). Prompts are sent concurrently over pooled keep-alive
+    connections so the server can batch them. Responses are cached under
+    `<model>:openai@<base_url>`, apart from the same model run in-process."""
+
+    def __init__(self, base_url: str, model_name: str, api_key: str = None, max_concurrency: int = 16,
+                 timeout: float = 600.0):
+        parsed = urllib.parse.urlsplit(base_url)
+        self.connection_class = http.client.HTTPSConnection if parsed.scheme == "https" else http.client.HTTPConnection
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.path = parsed.path.rstrip("/") + "/chat/completions"
+        self.server_model = model_name
+        self.model_name = f"{model_name}:openai@{base_url}"
+        self.headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+        if api_key:
+            self.headers["Authorization"] = f"Bearer {api_key}"
+        self.timeout = timeout
+        self.connections = queue.LifoQueue()
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def _connection(self):
+        try:
+            return self.connections.get_nowait()
+        except queue.Empty:
+            return self.connection_class(self.host, self.port, timeout=self.timeout)
+
+    def complete(self, prompt: str, max_new_tokens: int = 128) -> str:
+        body = json.dumps({
+            "model": self.server_model,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": max_new_tokens,
+            "temperature": 0,
+        })
+        conn = self._connection()
+        for attempt in range(2):
+            try:
+                conn.request("POST", self.path, body=body, headers=self.headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if attempt:
+                    raise
+                # A pooled connection the server has since closed: the rest of the
+                # pool has idled as long, so it is dropped and a fresh one is opened
+                self.drop_pool()
+                conn = self.connection_class(self.host, self.port, timeout=self.timeout)
+                continue
+            if response.status != 200:
+                conn.close()
+                raise RuntimeError(f"Server returned {response.status}: {data[:500]!r}")
+            self.connections.put(conn)
+            return json.loads(data)["choices"][0]["message"]["content"].strip()
+
+    def generate(self, prompts: List[str], max_new_tokens: int = 128) -> List[str]:
+        return list(self.executor.map(lambda prompt: self.complete(prompt, max_new_tokens), prompts))
+
+    def drop_pool(self):
+        while True:
+            try:
+                self.connections.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def close(self):
+        self.executor.shutdown()
+        self.drop_pool()
+
+
+class StubBackend(Backend):
+    """Deterministic backend for tests: each response depends only on its prompt
+    and follows the agent or aggregator output format. To simulate a model,
+    `latency` seconds are slept per generate call plus `latency_per_prompt` per
+    prompt in it. Explanations run `explanation_words` words, like a real
+    agent's step-by-step reasoning."""
+
+    def __init__(self, model_name: str = "stub", latency: float = 0.0, latency_per_prompt: float = 0.0,
+                 num_answers: int = 3, explanation_words: int = 80):
+        self.model_name = model_name
+        self.latency = latency
+        self.latency_per_prompt = latency_per_prompt
+        self.num_answers = num_answers
+        self.explanation_words = explanation_words
+        self.calls = 0
+        self.prompts = 0
+
+    def respond(self, prompt: str) -> str:
+        digest = int(hashlib.sha256(prompt.encode("utf-8")).hexdigest(), 16)
+        answer = f"answer {digest % self.num_answers}"
+        explanation = " ".join(f"w{(digest >> k) % 97}" for k in range(self.explanation_words))
+        if prompt.startswith("You are an aggregator"):
+            return f'All Correct Answers: ["{answer}"]. Explanation: {explanation}.'
+        return f"Answer: {answer}. Explanation: {explanation}."
+
+    def generate(self, prompts: List[str], max_new_tokens: int = 128) -> List[str]:
+        if not prompts:
+            return []
+        self.calls += 1
+        self.prompts += len(prompts)
+        if self.latency or self.latency_per_prompt:
+            time.sleep(self.latency + self.latency_per_prompt * len(prompts))
+        return [self.respond(prompt) for prompt in prompts]
+
+
+class CachedBackend(Backend):
+    """Serves prompts from a ResponseCache and sends only the misses (deduplicated)
+    to the wrapped backend. Decoding is greedy, so cached responses are exact."""
+
+    def __init__(self, backend: Backend, cache):
+        self.backend = backend
+        self.cache = cache
+        self.model_name = backend.model_name
+
+    def generate(self, prompts: List[str], max_new_tokens: int = 128) -> List[str]:
+        keys = [self.cache.make_key(self.model_name, prompt, max_new_tokens) for prompt in prompts]
+        found = self.cache.get_many(keys)
+        missing = {key: prompt for key, prompt in zip(keys, prompts) if key not in found}
+        generated = dict(zip(missing, self.backend.generate(list(missing.values()), max_new_tokens)))
+        self.cache.put_many(generated)
+        found.update(generated)
+        return [found[key] for key in keys]
+
+    def count_tokens(self, prompts: List[str]) -> int:
+        return self.backend.count_tokens(prompts)
+
+    def stats(self) -> str:
+        return "\n".join(text for text in [self.cache.stats(), self.backend.stats()] if text)
+
+    def close(self):
+        self.cache.close()
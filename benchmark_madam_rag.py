@@ -0,0 +1,248 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+from typing import List
+
+from backends import Backend, HFBackend, StubBackend
+from prompt_budget import PromptBudget
+from run_madam_rag import async_run_debates, build_agent_prompt, iter_dataset, normalize_answer, run_debates
+
+# Orchestration benchmarks: the debate loop is driven by a deterministic stub (or
+# an optional tiny CPU model), so changes to the drivers and prompt building can
+# be measured without a real model. Call counts and prompt tokens are exact;
+# throughput reflects the simulated latency of each generate call.
+
+SCENARIOS = {
+    "sequential": {"driver": "batch", "max_active": 1},
+    "continuous": {"driver": "batch", "max_active": 8},
+    "async": {"driver": "async", "max_active": 8},
+    "answers_history": {"driver": "batch", "max_active": 8, "options": {"history_mode": "answers"}},
+    "digest_history": {"driver": "batch", "max_active": 8, "options": {"history_mode": "digest"}},
+    "lean_aggregation": {"driver": "batch", "max_active": 8,
+                         "options": {"aggregation": "final", "unanimity_shortcut": True}},
+    "freeze_agents": {"driver": "batch", "max_active": 8, "options": {"freeze_agents": True}},
+    "dedup_documents": {"driver": "batch", "max_active": 8, "options": {"dedup_documents": True}},
+    "tree_aggregation": {"driver": "batch", "max_active": 8, "options": {"aggregation_group_size": 4}},
+    "bm25_prefilter": {"driver": "batch", "max_active": 8,
+                       "options": {"prefilter": "bm25", "prefilter_threshold": 0.1}},
+    "prompt_budget": {"driver": "batch", "max_active": 8, "max_prompt_tokens": 256},
+}
+
+
+class CountingBackend(Backend):
+    def __init__(self, backend: Backend):
+        self.backend = backend
+        self.model_name = backend.model_name
+        self.calls = 0
+        self.prompts = 0
+
+    def generate(self, prompts: List[str], max_new_tokens: int = 128) -> List[str]:
+        if prompts:
+            self.calls += 1
+            self.prompts += len(prompts)
+        return self.backend.generate(prompts, max_new_tokens)
+
+    def count_tokens(self, prompts: List[str]) -> int:
+        return self.backend.count_tokens(prompts)
+
+
+def load_dataset(data_path: str, max_samples: int, scale: int = 1, duplicates: int = 0):
+    # scale > 1 builds synthetic inputs with every question's documents repeated
+    # `scale` times (with a marker so prompts stay distinct); `duplicates` adds
+    # that many copies of each question's first document that differ from it only
+    # in whitespace, as a retriever returning the same passage again would
+    items = []
+    for index, query, documents in iter_dataset(data_path, max_samples):
+        if scale > 1:
+            documents = [f"{doc} [copy {k + 1}]" for k in range(scale) for doc in documents]
+        if duplicates and documents:
+            documents = documents + [" ".join(documents[0].split()) + " " * k for k in range(duplicates)]
+        items.append((index, query, documents))
+    return items
+
+
+def run_scenario(items, backend: Backend, scenario: dict, num_rounds: int, repeats: int = 1) -> dict:
+    # Counts come from the last repeat (they are identical); the wall time is the
+    # best of `repeats` runs to damp scheduler noise
+    options = dict(scenario.get("options", {}))
+    if scenario.get("max_prompt_tokens"):
+        options["prompt_budget"] = PromptBudget(scenario["max_prompt_tokens"], backend.count_tokens,
+                                                build_agent_prompt)
+    wall_s = float("inf")
+    for _ in range(repeats):
+        counting = CountingBackend(backend)
+        token_counts = {}
+        started = time.perf_counter()
+        if scenario["driver"] == "async":
+            asyncio.run(async_run_debates(items, counting, lambda i, result: None, num_rounds=num_rounds,
+                                          max_active=scenario["max_active"], debate_options=options,
+                                          token_counts=token_counts))
+        else:
+            for _ in run_debates(items, counting, num_rounds=num_rounds, max_active=scenario["max_active"],
+                                 debate_options=options, token_counts=token_counts):
+                pass
+        wall_s = min(wall_s, time.perf_counter() - started)
+    return {
+        "questions": len(items),
+        "wall_s": round(wall_s, 4),
+        "questions_per_s": round(len(items) / wall_s, 3),
+        "llm_calls": counting.calls,
+        "llm_calls_per_question": round(counting.calls / len(items), 3),
+        "prompts_per_question": round(counting.prompts / len(items), 3),
+        "prompt_tokens": dict(sorted(token_counts.items()), total=sum(token_counts.values())),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    # Counts must match exactly; throughput may drop by at most `tolerance`
+    problems = []
+    for name, expected in baseline["results"].items():
+        got = results.get(name)
+        if got is None:
+            continue
+        for key in ["llm_calls", "prompts_per_question", "prompt_tokens"]:
+            if got[key] != expected[key]:
+                problems.append(f"{name}: {key} changed from {expected[key]} to {got[key]}")
+        if got["questions_per_s"] < expected["questions_per_s"] * (1 - tolerance):
+            problems.append(f"{name}: throughput fell from {expected['questions_per_s']} "
+                            f"to {got['questions_per_s']} questions/s")
+    return problems
+
+
+def load_tiny_model(model_name: str, batch_size: int, int8: bool = False, compiled: bool = False):
+    from transformers import pipeline
+    generator = pipeline("text-generation", model=model_name, device="cpu")
+    if int8:
+        from quantization import quantize_int8
+        generator.model = quantize_int8(generator.model)
+    generator.tokenizer.pad_token_id = generator.tokenizer.eos_token_id
+    generator.tokenizer.padding_side = "left"
+    if compiled:
+        from compiled_generation import CompiledGenerator
+        generator = CompiledGenerator(generator.model, generator.tokenizer, batch_size=batch_size)
+    return HFBackend(generator, batch_size=batch_size)
+
+
+def per_token_latency(backend: HFBackend, prompts: List[str], max_new_tokens: int = 128) -> float:
+    # Milliseconds per generated token once warm: the first pass over the prompts
+    # absorbs compilation and allocation and is not counted
+    backend.generate(prompts, max_new_tokens)
+    backend.generated_tokens, backend.generate_seconds = 0, 0.0
+    backend.generate(prompts, max_new_tokens)
+    return round(1000 * backend.generate_seconds / backend.generated_tokens, 3)
+
+
+def compare_outputs(items, reference: Backend, candidate: Backend, num_rounds: int) -> dict:
+    # Latency and agreement of a candidate model (e.g. int8) against the reference
+    # outputs. Round 1 agent prompts are identical for both, so their answers
+    # compare like for like; later rounds inherit any earlier divergence.
+    runs = {}
+    for name, backend in [("reference", reference), ("candidate", candidate)]:
+        started = time.perf_counter()
+        records = dict(run_debates(items, backend, num_rounds=num_rounds, max_active=1))
+        runs[name] = (time.perf_counter() - started, records)
+    (ref_s, ref_records), (cand_s, cand_records) = runs["reference"], runs["candidate"]
+    same_answers = total_answers = same_final = 0
+    for index, ref in ref_records.items():
+        cand = cand_records[index]
+        for a, b in zip(ref["round1"]["answers"], cand["round1"]["answers"]):
+            same_answers += normalize_answer(a) == normalize_answer(b)
+            total_answers += 1
+        same_final += ref["final_aggregation"] == cand["final_aggregation"]
+    return {
+        "reference_wall_s": round(ref_s, 3),
+        "candidate_wall_s": round(cand_s, 3),
+        "speedup": round(ref_s / cand_s, 2),
+        "round1_answer_agreement": round(same_answers / total_answers, 3),
+        "final_aggregation_agreement": round(same_final / len(ref_records), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the MADAM-RAG debate orchestration")
+    parser.add_argument("--data_path", type=str, default="RAMDocs_test.jsonl")
+    parser.add_argument("--max_samples", type=int, default=50)
+    parser.add_argument("--num_rounds", type=int, default=3)
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 4],
+                        help="Document multipliers for synthetic scaled-up inputs (1 = RAMDocs as is)")
+    parser.add_argument("--duplicates", type=int, default=2,
+                        help="Whitespace-only copies of each question's first document in the duplicated input "
+                             "that the continuous and dedup_documents scenarios also run on (0 to skip it)")
+    parser.add_argument("--scenarios", type=str, nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument("--latency", type=float, default=0.005,
+                        help="Simulated seconds per generate call of the fake generator")
+    parser.add_argument("--latency_per_prompt", type=float, default=0.0005,
+                        help="Simulated seconds per prompt in a generate call")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--tiny_model", type=str, default=None,
+                        help="Also run a small local CPU model, e.g. HuggingFaceTB/SmolLM2-135M-Instruct")
+    parser.add_argument("--tiny_model_samples", type=int, default=3)
+    parser.add_argument("--int8", action="store_true",
+                        help="Compare the latency and answers of the int8 quantized tiny model against fp32")
+    parser.add_argument("--compiled", action="store_true",
+                        help="Compare warm per-token latency of the tiny model with --compile against the default")
+    parser.add_argument("--save_baseline", type=str, default=None)
+    parser.add_argument("--compare", type=str, default=None, help="Baseline JSON to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed relative drop in throughput before a regression is reported")
+    args = parser.parse_args()
+
+    results = {}
+    for scale in args.scales:
+        items = load_dataset(args.data_path, args.max_samples, scale)
+        dataset = "ramdocs" if scale == 1 else f"synthetic_x{scale}"
+        for name in args.scenarios:
+            backend = StubBackend(latency=args.latency, latency_per_prompt=args.latency_per_prompt)
+            results[f"{dataset}/{name}"] = run_scenario(items, backend, SCENARIOS[name], args.num_rounds,
+                                                        args.repeats)
+    if args.duplicates:
+        items = load_dataset(args.data_path, args.max_samples, duplicates=args.duplicates)
+        for name in [name for name in ["continuous", "dedup_documents"] if name in args.scenarios]:
+            backend = StubBackend(latency=args.latency, latency_per_prompt=args.latency_per_prompt)
+            results[f"duplicated/{name}"] = run_scenario(items, backend, SCENARIOS[name], args.num_rounds,
+                                                         args.repeats)
+
+    if args.tiny_model:
+        backend = load_tiny_model(args.tiny_model, batch_size=None)
+        items = load_dataset(args.data_path, args.tiny_model_samples)
+        for name in ["sequential", "continuous"]:
+            results[f"tiny_model/{name}"] = run_scenario(items, backend, SCENARIOS[name], args.num_rounds)
+        if args.int8:
+            int8 = compare_outputs(items, backend, load_tiny_model(args.tiny_model, batch_size=None, int8=True),
+                                   args.num_rounds)
+            print(f"int8 vs fp32: {json.dumps(int8)}")
+        if args.compiled:
+            # Round 1 agent prompts of the sample, in batches of 8 for both paths
+            prompts = [build_agent_prompt(query, document) for _, query, documents in items for document in documents]
+            default_ms = per_token_latency(load_tiny_model(args.tiny_model, batch_size=8), prompts)
+            compiled_ms = per_token_latency(load_tiny_model(args.tiny_model, batch_size=8, compiled=True), prompts)
+            print(f"Warm per-token latency: default {default_ms} ms, compiled {compiled_ms} ms "
+                  f"({default_ms / compiled_ms:.2f}x)")
+
+    for name, result in results.items():
+        print(f"{name:<32} {result['questions_per_s']:>8.2f} q/s  {result['llm_calls_per_question']:>6.2f} calls/q  "
+              f"{result['prompts_per_question']:>6.2f} prompts/q  {result['prompt_tokens']['total']:>9} prompt tokens")
+
+    config = {key: getattr(args, key) for key in ["max_samples", "num_rounds", "latency", "latency_per_prompt",
+                                                  "duplicates"]}
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"config": config, "results": results}, f, indent=2)
+            f.write("\n")
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        if baseline["config"] != config:
+            print(f"Warning: baseline was recorded with {baseline['config']}")
+        problems = compare(results, baseline, args.tolerance)
+        for problem in problems:
+            print(f"REGRESSION {problem}")
+        if problems:
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import os
+import shutil
+
+import onnxruntime
+from optimum.onnxruntime import ORTModelForCausalLM
+from transformers import AutoTokenizer, pipeline
+
+
+def onnx_model_dir(model_name: str, cache_dir: str) -> str:
+    return os.path.join(cache_dir, "onnx", model_name.replace("/", "--"))
+
+
+def load_onnx_generator(model_name: str, cache_dir: str, token: str = None, num_threads: int = None):
+    """Text-generation pipeline running the model on ONNX Runtime (CPU).
+
+    The model is exported once, with past key/values inputs and outputs so decoding
+    reuses the KV cache, into `<cache_dir>/onnx/<model_name>`; later runs load the
+    exported graph directly. Sessions apply all ORT graph optimizations.
+    """
+    path = onnx_model_dir(model_name, cache_dir)
+    session_options = onnxruntime.SessionOptions()
+    session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads:
+        session_options.intra_op_num_threads = num_threads
+
+    if not os.path.exists(path):
+        print(f"Exporting {model_name} to ONNX in {path}")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        model = ORTModelForCausalLM.from_pretrained(model_name, export=True, use_cache=True, cache_dir=cache_dir,
+                                                    token=token)
+        model.save_pretrained(tmp_path)
+        AutoTokenizer.from_pretrained(model_name, cache_dir=cache_dir, token=token).save_pretrained(tmp_path)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process finished the same export first
+            shutil.rmtree(tmp_path)
+
+    model = ORTModelForCausalLM.from_pretrained(path, use_cache=True, provider="CPUExecutionProvider",
+                                                session_options=session_options)
+    tokenizer = AutoTokenizer.from_pretrained(path)
+    tokenizer.pad_token_id = tokenizer.eos_token_id
+    # Decoder-only models must be left-padded so batched rows generate like single prompts
+    tokenizer.padding_side = "left"
+    return pipeline("text-generation", model=model, tokenizer=tokenizer)
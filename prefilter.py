@@ -0,0 +1,104 @@
+import argparse
+import json
+import re
+from typing import List
+
+import numpy as np
+
+STOPWORDS = frozenset(
+    "a an and are as at be by did do does for from had has have he her his how in is it its of on or she that the "
+    "their they this to was were what when where which who whom whose why will with".split())
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in re.findall(r"\w+", text.lower()) if token not in STOPWORDS]
+
+
+def term_counts(query: str, documents: List[str]):
+    # Counts of every distinct query term in every document, as a (documents x
+    # terms) matrix, plus the document lengths in tokens
+    terms = np.array(sorted(set(tokenize(query))))
+    tokens = [tokenize(doc) for doc in documents]
+    lengths = np.array([len(doc_tokens) for doc_tokens in tokens], dtype=float)
+    counts = np.zeros((len(documents), len(terms)))
+    flat = np.array([token for doc_tokens in tokens for token in doc_tokens])
+    if len(terms) and len(flat):
+        doc_ids = np.repeat(np.arange(len(documents)), lengths.astype(int))
+        positions = np.minimum(np.searchsorted(terms, flat), len(terms) - 1)
+        match = terms[positions] == flat
+        np.add.at(counts, (doc_ids[match], positions[match]), 1)
+    return counts, lengths
+
+
+def bm25_scores(query: str, documents: List[str], k1: float = 1.5, b: float = 0.75) -> np.ndarray:
+    # BM25 of each document for the query, with document frequencies taken over
+    # the question's own documents
+    counts, lengths = term_counts(query, documents)
+    df = (counts > 0).sum(axis=0)
+    idf = np.log((len(documents) - df + 0.5) / (df + 0.5) + 1)
+    norm = k1 * (1 - b + b * lengths / max(lengths.mean(), 1.0))
+    return (idf * counts * (k1 + 1) / (counts + norm[:, None])).sum(axis=1)
+
+
+def overlap_scores(query: str, documents: List[str]) -> np.ndarray:
+    # Fraction of the distinct query terms that occur in each document
+    counts, _ = term_counts(query, documents)
+    if not counts.shape[1]:
+        return np.ones(len(documents))
+    return (counts > 0).mean(axis=1)
+
+
+def select_documents(query: str, documents: List[str], method: str = "bm25", threshold: float = 0.0,
+                     top_k: int = None) -> List[bool]:
+    """Which documents to debate. A document is kept if its score reaches
+    `threshold` (for bm25 relative to the question's best document, so both
+    methods score in [0, 1]) and, with `top_k`, it ranks among the `top_k` best.
+    The best document is always kept."""
+    if method == "bm25":
+        scores = bm25_scores(query, documents)
+        scores = scores / scores.max() if scores.max() > 0 else np.ones(len(documents))
+    elif method == "overlap":
+        scores = overlap_scores(query, documents)
+    else:
+        raise ValueError(f"Unknown prefilter: {method}")
+    keep = scores >= threshold
+    order = np.argsort(-scores, kind="stable")
+    if top_k:
+        keep[order[top_k:]] = False
+    keep[order[0]] = True
+    return keep.tolist()
+
+
+def recall_table(data_path: str, method: str, thresholds: List[float], top_ks: List[int]) -> str:
+    # How many RAMDocs documents of each type survive each setting
+    entries = [json.loads(line) for line in open(data_path, "r") if line.strip()]
+    settings = [(threshold, None) for threshold in thresholds] + [(0.0, top_k) for top_k in top_ks]
+    lines = [f"{'setting':<18} {'kept':>7} {'correct':>8} {'misinfo':>8} {'noise':>8}"]
+    for threshold, top_k in settings:
+        kept = {"correct": 0, "misinfo": 0, "noise": 0}
+        total = dict.fromkeys(kept, 0)
+        for entry in entries:
+            documents = entry["documents"]
+            keep = select_documents(entry["question"], [doc["text"] for doc in documents], method, threshold, top_k)
+            for doc, kept_doc in zip(documents, keep):
+                total[doc["type"]] += 1
+                kept[doc["type"]] += kept_doc
+        name = f"top_k {top_k}" if top_k else f"threshold {threshold:g}"
+        lines.append(f"{name:<18} {sum(kept.values()) / sum(total.values()):>7.1%} "
+                     + " ".join(f"{kept[kind] / max(total[kind], 1):>8.1%}" for kind in kept))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall of the noise-document prefilter on RAMDocs")
+    parser.add_argument("--data_path", type=str, default="RAMDocs_test.jsonl")
+    parser.add_argument("--method", type=str, default="bm25", choices=["bm25", "overlap"])
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.0, 0.05, 0.1, 0.2, 0.3, 0.5])
+    parser.add_argument("--top_ks", type=int, nargs="*", default=[2, 3, 4, 5])
+    args = parser.parse_args()
+    print(f"Share of documents kept per type ({args.method})")
+    print(recall_table(args.data_path, args.method, args.thresholds, args.top_ks))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import copy
+from collections import OrderedDict
+
+import torch
+from transformers import DynamicCache
+
+
+class PrefixCachingGenerator:
+    """Drop-in replacement for the text-generation pipeline that reuses prompt KV caches.
+
+    The KV cache of each prompt is kept after generation (LRU, `max_entries`). A new
+    prompt is matched token-wise against the cached prompts, the best match is cropped
+    to the shared prefix and only the remaining tokens are prefilled. This covers the
+    aggregator's fixed few-shot preamble and each agent's "Question/Document" prefix,
+    which its round 2+ prompts share with round 1.
+
+    Prompts run one at a time: left padding a batch would shift every cached prefix.
+    """
+
+    def __init__(self, model, tokenizer, max_entries: int = 64, min_prefix_tokens: int = 16):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.min_prefix_tokens = min_prefix_tokens
+        self.entries = OrderedDict()
+        self.next_key = 0
+        self.reused_tokens = 0
+        self.prefilled_tokens = 0
+
+    def __call__(self, messages, max_new_tokens: int = 128, pad_token_id: int = None, **kwargs):
+        # Accepts the pipeline's batched chat call; decoding is always greedy
+        outputs = []
+        for conversation in messages:
+            text = self.generate(conversation, max_new_tokens, pad_token_id)
+            outputs.append([{"generated_text": conversation + [{"role": "assistant", "content": text}]}])
+        return outputs
+
+    def _longest_prefix(self, ids):
+        best_key, best_len = None, 0
+        for key, (cached_ids, _) in self.entries.items():
+            n = min(len(cached_ids), len(ids))
+            mismatch = (cached_ids[:n] != ids[:n]).nonzero()
+            common = int(mismatch[0]) if len(mismatch) else n
+            if common > best_len:
+                best_key, best_len = key, common
+        return best_key, best_len
+
+    def _store(self, ids, cache):
+        # A cached prompt that the new one fully extends is redundant
+        for key, (cached_ids, _) in list(self.entries.items()):
+            if len(cached_ids) <= len(ids) and torch.equal(cached_ids, ids[:len(cached_ids)]):
+                del self.entries[key]
+        self.entries[self.next_key] = (ids, cache)
+        self.next_key += 1
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    @torch.no_grad()
+    def generate(self, conversation, max_new_tokens: int = 128, pad_token_id: int = None) -> str:
+        text = self.tokenizer.apply_chat_template(conversation, tokenize=False, add_generation_prompt=True)
+        input_ids = self.tokenizer(text, return_tensors="pt", add_special_tokens=False).input_ids.to(self.model.device)
+        ids = input_ids[0]
+
+        key, common = self._longest_prefix(ids)
+        # At least one prompt token must be prefilled to produce the first logits
+        common = min(common, len(ids) - 1)
+        if key is not None and common >= self.min_prefix_tokens:
+            self.entries.move_to_end(key)
+            past_key_values = copy.deepcopy(self.entries[key][1])
+            past_key_values.crop(common)
+        else:
+            common = 0
+            past_key_values = DynamicCache()
+        self.reused_tokens += common
+        self.prefilled_tokens += len(ids) - common
+
+        output = self.model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=past_key_values,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            top_p=None,
+            pad_token_id=pad_token_id,
+            return_dict_in_generate=True)
+        cache = output.past_key_values
+        cache.crop(len(ids))
+        self._store(ids, cache)
+        return self.tokenizer.decode(output.sequences[0, len(ids):], skip_special_tokens=True)
+
+    def stats(self) -> str:
+        total = self.reused_tokens + self.prefilled_tokens
+        rate = self.reused_tokens / total if total else 0.0
+        return (f"Prefix cache: {self.reused_tokens} prompt tokens reused, "
+                f"{self.prefilled_tokens} prefilled ({rate:.1%} of prefill skipped)")
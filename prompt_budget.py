@@ -0,0 +1,111 @@
+import re
+from typing import Callable, List
+
+from prefilter import tokenize
+
+
+def split_sentences(text: str) -> List[str]:
+    return [sentence for sentence in re.split(r"(?<=[.!?])\s+", text.strip()) if sentence]
+
+
+def truncate_words(text: str, max_tokens: int, num_tokens: int) -> str:
+    # Keeps the share of words that should fit in `max_tokens`, given the text's
+    # token count, leaving a token for the "..." marker
+    words = text.split()
+    keep = int(len(words) * (max_tokens - 1) / num_tokens) if num_tokens else len(words)
+    return " ".join(words[:max(keep, 0)]) + " ..."
+
+
+class PromptBudget:
+    """Fits every agent prompt into `max_prompt_tokens` tokens.
+
+    The history of other agents' responses gets at most `history_share` of the
+    budget, trimmed evenly across agents. The document gets the rest: if it does
+    not fit, its sentences are kept in order of how many question terms they
+    contain (then position) while they fit, and are put back in document order
+    with "..." marking the gaps. `count_tokens` is the backend's token counter.
+    """
+
+    def __init__(self, max_prompt_tokens: int, count_tokens: Callable[[List[str]], int], build_prompt,
+                 history_share: float = 0.5):
+        self.max_prompt_tokens = max_prompt_tokens
+        self.count_tokens = count_tokens
+        self.build_prompt = build_prompt
+        self.history_share = history_share
+        self.counts = {}
+        self.prompts = 0
+        self.trimmed_documents = 0
+        self.trimmed_histories = 0
+        self.dropped_document_tokens = 0
+        self.dropped_history_tokens = 0
+
+    def count(self, text: str) -> int:
+        # Documents and responses recur across rounds; their counts are memoized
+        if text not in self.counts:
+            if len(self.counts) > 100000:
+                self.counts.clear()
+            self.counts[text] = self.count_tokens([text])
+        return self.counts[text]
+
+    def fit_history(self, history: str) -> str:
+        budget = int(self.max_prompt_tokens * self.history_share)
+        num_tokens = self.count(history)
+        if num_tokens <= budget:
+            return history
+        blocks = re.split(r"\n(?=Agent \d+: )", history)
+        share = budget // len(blocks)
+        fitted = [block if self.count(block) <= share else truncate_words(block, share, self.count(block))
+                  for block in blocks]
+        history = "\n".join(fitted)
+        self.trimmed_histories += 1
+        self.dropped_history_tokens += num_tokens - self.count(history)
+        return history
+
+    def fit_document(self, query: str, document: str, budget: int) -> str:
+        num_tokens = self.count(document)
+        if num_tokens <= budget:
+            return document
+        sentences = split_sentences(document)
+        terms = set(tokenize(query))
+        ranked = sorted(range(len(sentences)),
+                        key=lambda k: (-len(terms.intersection(tokenize(sentences[k]))), k))
+        chosen, used = [], 0
+        for k in ranked:
+            sentence_tokens = self.count(sentences[k])
+            if used + sentence_tokens <= budget:
+                chosen.append(k)
+                used += sentence_tokens
+        fitted = self.join_sentences(sentences, chosen)
+        # The "..." markers are not in the estimate; drop the weakest sentences until they fit too
+        while len(chosen) > 1 and self.count(fitted) > budget:
+            chosen.pop()
+            fitted = self.join_sentences(sentences, chosen)
+        if not chosen:
+            # Not even the best sentence fits
+            best = sentences[ranked[0]]
+            fitted = truncate_words(best, budget, self.count(best))
+        self.trimmed_documents += 1
+        self.dropped_document_tokens += num_tokens - self.count(fitted)
+        return fitted
+
+    @staticmethod
+    def join_sentences(sentences: List[str], chosen: List[int]) -> str:
+        # The chosen sentences in document order, with "..." where sentences were cut
+        chosen = sorted(chosen)
+        parts = [sentences[k] for k in chosen[:1]]
+        for previous, k in zip(chosen, chosen[1:]):
+            parts.append(("... " if k > previous + 1 else "") + sentences[k])
+        return " ".join(parts)
+
+    def build(self, query: str, document: str, history: str = "") -> str:
+        self.prompts += 1
+        if history:
+            history = self.fit_history(history)
+        overhead = self.count(self.build_prompt(query, "", history))
+        return self.build_prompt(query, self.fit_document(query, document, self.max_prompt_tokens - overhead),
+                                 history)
+
+    def stats(self) -> str:
+        return (f"Prompt budget ({self.max_prompt_tokens} tokens): {self.trimmed_documents} of {self.prompts} "
+                f"agent documents trimmed ({self.dropped_document_tokens} tokens dropped), "
+                f"{self.trimmed_histories} histories trimmed ({self.dropped_history_tokens} tokens dropped)")
@@ -0,0 +1,29 @@
+import os
+
+import torch
+
+
+def quantize_int8(model):
+    # Dynamic int8 quantization: Linear weights are stored as int8 and activations
+    # are quantized on the fly per batch, so no calibration data is needed. CPU only.
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def int8_cache_path(model_name: str, cache_dir: str) -> str:
+    return os.path.join(cache_dir, model_name.replace("/", "--") + ".int8.pt")
+
+
+def load_int8_model(model_name: str, cache_dir: str, load_fp32):
+    """Returns the int8 model from the on-disk cache, or quantizes the fp32 model
+    returned by `load_fp32()` and caches it for later runs."""
+    path = int8_cache_path(model_name, cache_dir)
+    if os.path.exists(path):
+        print(f"Loading int8 model from {path}")
+        return torch.load(path, weights_only=False)
+    model = quantize_int8(load_fp32())
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(model, tmp_path)
+    os.replace(tmp_path, path)
+    print(f"Saved int8 model to {path}")
+    return model
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+
+
+class ResponseCache:
+    """Persistent LLM response cache for greedy decoding.
+
+    Entries are keyed by a hash of (model, prompt, generation params) and stored in
+    SQLite. Once the stored responses exceed `max_size_mb`, the least recently used
+    entries are evicted. The connection may be used from any thread (e.g. the
+    worker threads of --async_debate); a lock serializes access to it.
+    """
+
+    def __init__(self, path: str, max_size_mb: float = 1024.0):
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used)")
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(model: str, prompt: str, max_new_tokens: int) -> str:
+        payload = json.dumps({"model": model, "prompt": prompt, "max_new_tokens": max_new_tokens,
+                              "do_sample": False}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        with self.lock:
+            return self._get_many(keys)
+
+    def _get_many(self, keys: List[str]) -> Dict[str, str]:
+        found = {}
+        unique = list(dict.fromkeys(keys))
+        # Stay well below SQLite's bound-parameter limit
+        for start in range(0, len(unique), 500):
+            chunk = unique[start:start + 500]
+            rows = self.conn.execute(
+                f"SELECT key, response FROM responses WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            found.update(rows.fetchall())
+        if found:
+            now = time.time()
+            self.conn.executemany("UPDATE responses SET last_used = ? WHERE key = ?",
+                                  [(now, key) for key in found])
+            self.conn.commit()
+        self.hits += sum(1 for key in keys if key in found)
+        self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, items: Dict[str, str]):
+        if not items:
+            return
+        with self.lock:
+            self._put_many(items)
+
+    def _put_many(self, items: Dict[str, str]):
+        now = time.time()
+        for key, response in items.items():
+            size = len(response.encode("utf-8"))
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, response, size, last_used) VALUES (?, ?, ?, ?)",
+                              (key, response, size, now))
+            self.size += size - (old[0] if old else 0)
+        self.conn.commit()
+        self.evict()
+
+    def evict(self):
+        while self.size > self.max_size:
+            rows = self.conn.execute("SELECT key, size FROM responses ORDER BY last_used LIMIT 256").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.size <= self.max_size:
+                    break
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.size -= size
+        self.conn.commit()
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return (f"Response cache: {self.hits} hits, {self.misses} misses ({rate:.1%} hit rate), "
+                f"{self.size / 1024 / 1024:.1f} MB stored in {self.path}")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -1,12 +1,26 @@
 import argparse
+import asyncio
+import copy
+import glob
+import itertools
+import multiprocessing
 import os
+import shutil
 import re
 import json
-import torch
 import string
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Full
 from tqdm import tqdm
 from typing import List
-from transformers import pipeline, AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig, set_seed
+
+from backends import CachedBackend, HFBackend, OpenAIServerBackend, StubBackend
+from prefilter import select_documents
+from prompt_budget import PromptBudget
+from response_cache import ResponseCache
+from tracing import Tracer, TracingBackend
+from work_queue import WorkQueue
 
 def normalize_answer(s: str) -> str:
     def remove_articles(text):
@@ -19,17 +33,11 @@ def normalize_answer(s: str) -> str:
         return text.lower()
     return white_space_fix(remove_articles(remove_punc(lower(s))))
 
-def call_llm(prompt: str, generator, max_new_tokens: int = 128) -> str:
-    messages = [{"role": "user", "content": prompt}]
-    output = generator(
-                messages,
-                max_new_tokens=max_new_tokens,
-                top_p=None,
-                do_sample=False)
-    return output[0]["generated_text"][-1]['content'].strip()
+def call_llm(prompt: str, backend, max_new_tokens: int = 128) -> str:
+    return backend.generate([prompt], max_new_tokens)[0]
 
 
-def agent_response(query: str, document: str, generator, history: str = ""):
+def build_agent_prompt(query: str, document: str, history: str = "") -> str:
     if history:
         prompt = f"""You are an agent reading a document to answer a question.
 
@@ -48,12 +56,21 @@ Document: {document}
 
 Answer the question based only on this document. Provide your answer and a step-by-step reasoning explanation.
 Please follow the format: 'Answer: {{}}. Explanation: {{}}.''"""
+    return prompt
+
 
-    output = call_llm(prompt, generator)
+def agent_response(query: str, document: str, backend, history: str = ""):
+    output = call_llm(build_agent_prompt(query, document, history), backend)
     return output
 
 
-def aggregate_responses(query: str, responses: List[str], generator):
+def parse_agent_response(response: str):
+    answer = response[response.find("Answer: ") + len("Answer: "):response.find("Explanation")].strip()
+    explanation = response[response.find("Explanation: ") + len("Explanation: "):]
+    return answer, explanation
+
+
+def build_aggregator_prompt(query: str, responses: List[str]) -> str:
     joined = "\n".join([f"Agent {i+1}: {r}" for i, r in enumerate(responses)])
     prompt = f"""You are an aggregator reading answers from multiple agents.
 
@@ -73,40 +90,325 @@ Question: {query}
 Agent responses:
 {joined}
 """
-    return call_llm(prompt, generator)
+    return prompt
 
 
-def multi_agent_debate(query: str, documents: List[str], generator, num_rounds: int = 3):
-    records = {}
+def aggregate_responses(query: str, responses: List[str], backend):
+    return call_llm(build_aggregator_prompt(query, responses), backend)
+
+
+def build_merge_prompt(query: str, partials: List[str]) -> str:
+    joined = "\n".join([f"Aggregator {i+1}: {p}" for i, p in enumerate(partials)])
+    prompt = f"""You are an aggregator merging the results of other aggregators, each of which read the answers of a different group of agents.
+
+Combine their lists into all possible correct answers, dropping answers that other groups show to be incorrect, and provide a step-by-step reasoning explanation. If there is no correct answer, please reply 'unknown'.
+Please follow the format: 'All Correct Answers: []. Explanation: {{}}.'
+
+Question: {query}
+Aggregator results:
+{joined}
+"""
+    return prompt
+
+
+def build_history_lines(records: dict, agent_outputs: List[str], history_mode: str = "full",
+                        digest_chars: int = 200) -> List[str]:
+    # One line per agent, built once per round. "full" repeats every agent's whole
+    # response (prompt size grows quadratically with the number of documents),
+    # "answers" passes only normalized answers, and "digest" adds an explanation
+    # capped at `digest_chars` characters.
+    lines = []
+    for j, output in enumerate(agent_outputs):
+        if history_mode == "full":
+            lines.append(f"Agent {j+1}: {output}")
+            continue
+        answer, explanation = records["answers"][j], records["explanations"][j]
+        if history_mode == "answers":
+            lines.append(f"Agent {j+1}: Answer: {normalize_answer(answer)}.")
+        elif history_mode == "digest":
+            explanation = " ".join(explanation.split())
+            if len(explanation) > digest_chars:
+                explanation = explanation[:digest_chars].rsplit(" ", 1)[0] + " ..."
+            lines.append(f"Agent {j+1}: Answer: {answer} Explanation: {explanation}")
+        else:
+            raise ValueError(f"Unknown history mode: {history_mode}")
+    return lines
+
+
+def shortcut_aggregation(answers: List[str]):
+    # A deterministic aggregation for rounds that need no judgement: every agent
+    # gave the same normalized answer, or every agent answered unknown
+    normalized = {normalize_answer(answer) for answer in answers}
+    if normalized == {"unknown"}:
+        return 'All Correct Answers: ["unknown"]. Explanation: Every agent answered unknown.', "all_unknown"
+    if len(normalized) == 1 and "" not in normalized:
+        answer = answers[0].strip().rstrip(".")
+        return f'All Correct Answers: ["{answer}"]. Explanation: Every agent gave the answer {answer}.', "unanimous"
+    return None, None
+
+
+def tree_aggregation(query: str, round_num: int, outputs: List[str], group_size: int):
+    # Aggregates the responses in groups of `group_size`, then merges the partial
+    # results group by group until one remains. Each level is one batched step, so
+    # a round takes about log(#agents) / log(group_size) aggregator steps and no
+    # prompt holds more than `group_size` responses.
+    groups = [outputs[k:k + group_size] for k in range(0, len(outputs), group_size)]
+    partials = yield "aggregator", round_num, [build_aggregator_prompt(query, group) for group in groups]
+    while len(partials) > 1:
+        groups = [partials[k:k + group_size] for k in range(0, len(partials), group_size)]
+        partials = yield "aggregator", round_num, [build_merge_prompt(query, group) for group in groups]
+    return partials[0]
+
+
+def aggregation_step(query: str, round_num: int, outputs: List[str], answers: List[str],
+                     unanimity_shortcut: bool = False, group_size: int = None):
+    # Sub-generator of debate_steps returning (aggregation, path)
+    if group_size is not None and group_size < 2:
+        # Groups of one would never shrink the tree
+        raise ValueError(f"Aggregation group size must be at least 2: {group_size}")
+    if unanimity_shortcut:
+        aggregation, path = shortcut_aggregation(answers)
+        if aggregation is not None:
+            return aggregation, path
+    if group_size and len(outputs) > group_size:
+        return (yield from tree_aggregation(query, round_num, outputs, group_size)), "tree"
+    return (yield "aggregator", round_num, [build_aggregator_prompt(query, outputs)])[0], "llm"
+
+
+def unique_documents(documents: List[str]):
+    # Documents that are identical up to whitespace share one agent: returns the
+    # unique texts and, per original slot, the index of its unique text
+    unique = []
+    slots = []
+    seen = {}
+    for doc in documents:
+        key = " ".join(doc.split())
+        if key not in seen:
+            seen[key] = len(unique)
+            unique.append(doc)
+        slots.append(seen[key])
+    return unique, slots
+
+
+def duplicate_positions(documents: List[str], filtered=()) -> List[int]:
+    # Slots whose document repeats an earlier one; slots in `filtered` were dropped
+    # by the prefilter and had no agent either way
+    first = {}
+    return [i for i, slot in enumerate(unique_documents(documents)[1])
+            if i not in filtered and first.setdefault(slot, i) != i]
+
+
+# What a document dropped by the prefilter contributes to every round
+FILTERED_SLOT = {"answers": "unknown", "explanations": "The document was filtered out as unrelated to the question.",
+                 "frozen": False}
+
+
+def fan_out_records(records: dict, slots: List[int]) -> dict:
+    # Expands the per-agent lists of a debate over unique documents back to one
+    # entry per original document; a None slot gets the prefilter placeholder
+    for key, value in records.items():
+        if key.startswith("round"):
+            for field in ["answers", "explanations", "frozen"]:
+                if field in value:
+                    value[field] = [value[field][slot] if slot is not None else FILTERED_SLOT[field]
+                                    for slot in slots]
+    return records
+
+
+def saved_agent_calls(records: dict, positions: List[int], first_round: int = 1) -> int:
+    # Agent calls a deduplicated debate did not make: one per duplicate slot in
+    # every round from `first_round` on where that agent was not frozen anyway
+    saved = 0
+    for key, value in records.items():
+        if key.startswith("round") and int(key[len("round"):]) >= first_round:
+            frozen = value.get("frozen")
+            saved += sum(1 for i in positions if not (frozen and frozen[i]))
+    return saved
+
+
+def collapse_records(records: dict, slots: List[int]) -> dict:
+    # The inverse of fan_out_records: keeps the first slot of every unique document
+    first = [slots.index(unique) for unique in range(max(slots) + 1)]
+    return fan_out_records(records, first)
+
+
+def answer_held(previous: str, current: str) -> bool:
+    # The convergence test of the debate on two raw answers
+    previous, current = normalize_answer(previous), normalize_answer(current)
+    return current in previous or previous in current
+
+
+def rebuild_responses(round_records: dict) -> List[str]:
+    # Agent responses as the aggregator and other agents saw them, from the stored
+    # answers and explanations of a round
+    return [f"Answer: {answer} Explanation: {explanation}"
+            for answer, explanation in zip(round_records["answers"], round_records["explanations"])]
+
+
+def replay_aggregation_steps(query: str, documents: List[str], records: dict, aggregation: str = "every_round",
+                             unanimity_shortcut: bool = False, aggregation_group_size: int = None,
+                             dedup_documents: bool = False):
+    # Reruns only the aggregator of a finished debate: every round that was
+    # aggregated is aggregated again from its agents' rebuilt responses, or with
+    # aggregation="final" only the round that gives the final aggregation. With
+    # `dedup_documents` duplicate slots are collapsed to the agent that debated
+    # them, so the aggregator sees the same responses as in the original run.
+    # Slots dropped by the prefilter had no agent and are left out.
+    filtered = set(records.get("filtered_documents", []))
+    agents = [i for i in range(len(documents)) if i not in filtered]
+    if dedup_documents and agents:
+        slots = unique_documents([documents[i] for i in agents])[1]
+        agents = [agents[slots.index(unique)] for unique in range(max(slots) + 1)]
+    final_aggregation = records.pop("final_aggregation", None)
+    aggregated = [key for key in records if key.startswith("round") and "aggregation" in records[key]]
+    final_key = aggregated[-1] if aggregated and final_aggregation is not None else None
+    for key in aggregated:
+        round_records = records[key]
+        if aggregation == "final" and key != final_key:
+            del round_records["aggregation"]
+            round_records["aggregation_path"] = "skipped"
+            continue
+        debated = {field: [round_records[field][i] for i in agents] for field in ["answers", "explanations"]}
+        round_records["aggregation"], path = yield from aggregation_step(
+            query, int(key[len("round"):]), rebuild_responses(debated), debated["answers"],
+            unanimity_shortcut, aggregation_group_size)
+        if aggregation != "every_round" or unanimity_shortcut or aggregation_group_size:
+            round_records["aggregation_path"] = path
+    records["final_aggregation"] = records[final_key]["aggregation"] if final_key else final_aggregation
+    return records
+
+
+def debate_steps(query: str, documents: List[str], num_rounds: int = 3, history_mode: str = "full",
+                 aggregation: str = "every_round", unanimity_shortcut: bool = False, freeze_agents: bool = False,
+                 dedup_documents: bool = False, prior: dict = None, replay_aggregation: bool = False,
+                 prefilter: str = None, prefilter_threshold: float = 0.0, prefilter_top_k: int = None,
+                 aggregation_group_size: int = None, prompt_budget=None):
+    # The debate written as a generator so any driver can schedule its LLM calls:
+    # it yields (role, round, prompts), is sent back the matching responses, and
+    # returns the finished records.
+    # aggregation="final" only aggregates the round that becomes the final
+    # aggregation; with `unanimity_shortcut` unanimous or all-unknown rounds are
+    # aggregated without an LLM call. Either option records each round's
+    # "aggregation_path" (llm, unanimous, all_unknown, tree or skipped). With
+    # `aggregation_group_size`, rounds with more agents are aggregated as a tree.
+    # A `prompt_budget` (PromptBudget) builds the agent prompts, fitting document
+    # and history into its token limit.
+    # With `freeze_agents`, an agent whose answer held for a round is frozen: its
+    # response is carried forward instead of regenerated, and each round 2+
+    # records which agents were "frozen".
+    # With `dedup_documents`, duplicate documents are debated by a single agent
+    # whose answers fill every slot of the duplicates.
+    # `prefilter` (bm25 or overlap) drops documents that score low against the
+    # question before any agent runs; their slots answer "unknown" and are listed
+    # in "filtered_documents".
+    # `prior` is the record of a finished debate of the same question to extend:
+    # unless it converged, the debate continues after its last round, with the
+    # agents' responses rebuilt from their stored answers and explanations. With
+    # `replay_aggregation` only the aggregations of `prior` are generated again.
+    if prior is not None:
+        prior = copy.deepcopy(prior)
+        prior.pop("index", None)
+        if replay_aggregation:
+            return (yield from replay_aggregation_steps(query, documents, prior, aggregation, unanimity_shortcut,
+                                                        aggregation_group_size, dedup_documents))
+    if prefilter is not None:
+        keep = select_documents(query, documents, prefilter, prefilter_threshold, prefilter_top_k)
+        if not all(keep):
+            kept = [i for i, kept_doc in enumerate(keep) if kept_doc]
+            records = yield from debate_steps(query, [documents[i] for i in kept], num_rounds, history_mode,
+                                              aggregation, unanimity_shortcut, freeze_agents, dedup_documents,
+                                              prior=prior and fan_out_records(prior, kept),
+                                              aggregation_group_size=aggregation_group_size,
+                                              prompt_budget=prompt_budget)
+            slots = [kept.index(i) if kept_doc else None for i, kept_doc in enumerate(keep)]
+            final_aggregation = records.pop("final_aggregation")
+            records["filtered_documents"] = [i for i, kept_doc in enumerate(keep) if not kept_doc]
+            records["final_aggregation"] = final_aggregation
+            return fan_out_records(records, slots)
+    if dedup_documents:
+        unique, slots = unique_documents(documents)
+        if len(unique) < len(documents):
+            records = yield from debate_steps(query, unique, num_rounds, history_mode, aggregation,
+                                              unanimity_shortcut, freeze_agents,
+                                              prior=prior and collapse_records(prior, slots),
+                                              aggregation_group_size=aggregation_group_size,
+                                              prompt_budget=prompt_budget)
+            return fan_out_records(records, slots)
     num_agents = len(documents)
+    build_prompt = prompt_budget.build if prompt_budget is not None else build_agent_prompt
+    records = {}
     agent_outputs = []
+    frozen = [False] * num_agents
+    final_aggregation = None
+    start = 1
+    if prior is not None:
+        records = prior
+        final_aggregation = records.pop("final_aggregation", None)
+        start = max(int(key[len("round"):]) for key in records if key.startswith("round"))
+        last = records[f"round{start}"]
+        # A debate that converged ended on a round without an aggregation
+        if start >= num_rounds or (start > 1 and "aggregation" not in last):
+            records["final_aggregation"] = final_aggregation
+            return records
+        agent_outputs = rebuild_responses(last)
+        if freeze_agents and start > 1:
+            frozen = [answer_held(previous, current) for previous, current
+                      in zip(records[f"round{start - 1}"]["answers"], last["answers"])]
+    note_path = aggregation != "every_round" or unanimity_shortcut or aggregation_group_size
 
-    # Round 1
-    records["round1"] = {"answers": [], "explanations": []}
-    for doc in documents:
-        response = agent_response(query, doc, generator)
-        answer = response[response.find("Answer: ") + len("Answer: "):response.find("Explanation")].strip()
-        explanation = response[response.find("Explanation: ") + len("Explanation: "):]
-        records["round1"]["answers"].append(answer)
-        records["round1"]["explanations"].append(explanation)
-        agent_outputs.append(response)
-    records["round1"]["aggregation"] = aggregate_responses(query, agent_outputs, generator)
+    def aggregate(round_num, outputs):
+        round_records = records[f"round{round_num}"]
+        round_records["aggregation"], path = yield from aggregation_step(
+            query, round_num, outputs, round_records["answers"], unanimity_shortcut, aggregation_group_size)
+        if note_path:
+            round_records["aggregation_path"] = path
+        return round_records["aggregation"]
+
+    def skip(round_num):
+        if note_path:
+            records[f"round{round_num}"]["aggregation_path"] = "skipped"
+
+    # Round 1: every agent's prompt is built up front and generated as one batch
+    if prior is None:
+        records["round1"] = {"answers": [], "explanations": []}
+        prompts = [build_prompt(query, doc) for doc in documents]
+        responses = yield "agent", 1, prompts
+        for response in responses:
+            answer, explanation = parse_agent_response(response)
+            records["round1"]["answers"].append(answer)
+            records["round1"]["explanations"].append(explanation)
+            agent_outputs.append(response)
+        if aggregation == "every_round" or num_rounds == 1:
+            yield from aggregate(1, agent_outputs)
+        else:
+            skip(1)
 
     # Additional rounds
-    final_aggregation = None
-    for t in range(1, num_rounds):
+    for t in range(start, num_rounds):
         round_key = f"round{t+1}"
         records[round_key] = {"answers": [], "explanations": []}
         new_outputs = []
+        prompts = []
+        history_lines = build_history_lines(records[f"round{t}"], agent_outputs, history_mode)
         for i, doc in enumerate(documents):
-            history = "\n".join([f"Agent {j+1}: {agent_outputs[j]}" for j in range(num_agents) if j != i])
-            response = agent_response(query, doc, generator, history)
-            answer = response[response.find("Answer: ") + len("Answer: "):response.find("Explanation")].strip()
-            explanation = response[response.find("Explanation: ") + len("Explanation: "):]
+            if frozen[i]:
+                continue
+            history = "\n".join([history_lines[j] for j in range(num_agents) if j != i])
+            prompts.append(build_prompt(query, doc, history))
+        responses = iter((yield "agent", t + 1, prompts) if prompts else [])
+        for i in range(num_agents):
+            if frozen[i]:
+                response = agent_outputs[i]
+                answer, explanation = records[f"round{t}"]["answers"][i], records[f"round{t}"]["explanations"][i]
+            else:
+                response = next(responses)
+                answer, explanation = parse_agent_response(response)
             records[round_key]["answers"].append(answer)
             records[round_key]["explanations"].append(explanation)
             new_outputs.append(response)
-        agent_outputs = new_outputs
+        if freeze_agents:
+            records[round_key]["frozen"] = list(frozen)
+        prev_outputs, agent_outputs = agent_outputs, new_outputs
         pred_ans_list = []
         for ans in records[round_key]["answers"]:
             pred_ans_list.append(normalize_answer(ans))
@@ -117,20 +419,549 @@ def multi_agent_debate(query: str, documents: List[str], generator, num_rounds:
         flag = True
         for k in range(len(pred_ans_list)):
             if pred_ans_list[k] in prev_pred_ans_list[k] or prev_pred_ans_list[k] in pred_ans_list[k]:
+                frozen[k] = freeze_agents
                 continue
             else:
                 flag = False
         if flag:
+            # The previous round's aggregation stands; in final-only mode it is computed now
+            if "aggregation" not in records[f"round{t}"]:
+                yield from aggregate(t, prev_outputs)
+            skip(t + 1)
             final_aggregation = records[f"round{t}"]["aggregation"]
             break
+        elif aggregation == "every_round" or t == num_rounds - 1:
+            final_aggregation = yield from aggregate(t + 1, agent_outputs)
         else:
-            records[round_key]["aggregation"] = aggregate_responses(query, agent_outputs, generator)
-            final_aggregation = records[round_key]["aggregation"]
+            skip(t + 1)
 
     records["final_aggregation"] = final_aggregation
     return records
 
 
+def account_step(backend, step, responses: List[str], wall_s: float, index: int = None, token_counts: dict = None,
+                 tracer=None, share_s: float = None):
+    # Adds a finished debate step's prompt tokens to `token_counts` and traces it.
+    # A step generated in a batch shared with other questions has the batch's
+    # `wall_s` as its latency and `share_s`, its prompts' share of that time,
+    # for totals that do not count the batch once per question.
+    if token_counts is None and tracer is None:
+        return
+    role, round_num, prompts = step
+    prompt_tokens = backend.count_tokens(prompts)
+    if token_counts is not None:
+        token_counts[role] = token_counts.get(role, 0) + prompt_tokens
+    if tracer is not None:
+        tracer.emit("step", index=index, role=role, round=round_num, num_prompts=len(prompts),
+                    prompt_tokens=prompt_tokens, generated_tokens=backend.count_tokens(responses), wall_s=wall_s,
+                    share_s=wall_s if share_s is None else share_s)
+
+
+def multi_agent_debate(query: str, documents: List[str], backend, num_rounds: int = 3, debate_options: dict = None,
+                       token_counts: dict = None, tracer=None, index: int = None, prior: dict = None):
+    # `debate_options` are passed on to debate_steps (history_mode, aggregation, ...)
+    steps = debate_steps(query, documents, num_rounds, prior=prior, **(debate_options or {}))
+    started = time.perf_counter()
+    try:
+        step = next(steps)
+        while True:
+            step_started = time.perf_counter()
+            responses = backend.generate(step[2])
+            account_step(backend, step, responses, time.perf_counter() - step_started, index, token_counts, tracer)
+            step = steps.send(responses)
+    except StopIteration as done:
+        if tracer is not None:
+            tracer.emit("question", index=index, num_documents=len(documents), wall_s=time.perf_counter() - started)
+        return done.value
+
+
+def run_debates(items, backend, num_rounds: int = 3, max_active: int = 8, debate_options: dict = None,
+                token_counts: dict = None, tracer=None):
+    # Continuous batching across questions: up to `max_active` debates are kept in
+    # flight, the prompts they are waiting on are sent to the backend together,
+    # and each debate advances as soon as its step's responses are back.
+    # `items` yields (index, query, documents), or (index, query, documents, prior)
+    # to extend the finished debate `prior`; (index, records) pairs are yielded
+    # in completion order. Prompt tokens per role are added to `token_counts`.
+    items = iter(items)
+    active = {}
+    exhausted = False
+    while True:
+        while not exhausted and len(active) < max_active:
+            try:
+                index, query, documents, prior = (*next(items), None)[:4]
+            except StopIteration:
+                exhausted = True
+                break
+            steps = debate_steps(query, documents, num_rounds, prior=prior, **(debate_options or {}))
+            try:
+                active[index] = (steps, next(steps), len(documents), time.perf_counter())
+            except StopIteration as done:
+                # An extended debate that had already converged
+                yield index, done.value
+        if not active:
+            return
+
+        pending = [(index, k, prompt) for index, (_, (_, _, prompts), _, _) in active.items()
+                   for k, prompt in enumerate(prompts)]
+        responses = {index: [None] * len(step[2]) for index, (_, step, _, _) in active.items()}
+        step_started = time.perf_counter()
+        outputs = backend.generate([prompt for _, _, prompt in pending])
+        wall_s = time.perf_counter() - step_started
+        for (index, k, _), output in zip(pending, outputs):
+            responses[index][k] = output
+
+        for index, outputs in responses.items():
+            steps, step, num_documents, started = active[index]
+            account_step(backend, step, outputs, wall_s, index, token_counts, tracer,
+                         share_s=wall_s * len(outputs) / len(pending))
+            try:
+                active[index] = (steps, steps.send(outputs), num_documents, started)
+            except StopIteration as done:
+                del active[index]
+                if tracer is not None:
+                    tracer.emit("question", index=index, num_documents=num_documents,
+                                wall_s=time.perf_counter() - started)
+                yield index, done.value
+
+
+async def generate_with_retry(backend, prompt: str, semaphore, timeout: float = 300.0, max_retries: int = 3,
+                              backoff: float = 1.0) -> str:
+    # One request under the global semaphore, retried with exponential backoff.
+    # A timed-out call cannot be interrupted inside its thread; the timeout only
+    # stops waiting for it.
+    for attempt in range(max_retries + 1):
+        try:
+            async with semaphore:
+                return (await asyncio.wait_for(asyncio.to_thread(backend.generate, [prompt]), timeout))[0]
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            delay = backoff * 2 ** attempt
+            print(f"LLM call failed ({e!r}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def async_multi_agent_debate(query: str, documents: List[str], backend, semaphore, num_rounds: int = 3,
+                                   debate_options: dict = None, token_counts: dict = None, tracer=None,
+                                   index: int = None, prior: dict = None, **retry_kwargs):
+    # Every prompt of a step (all agents of a round) is in flight at once; the
+    # convergence check and aggregation run in debate_steps as usual.
+    steps = debate_steps(query, documents, num_rounds, prior=prior, **(debate_options or {}))
+    started = time.perf_counter()
+    try:
+        step = next(steps)
+        while True:
+            step_started = time.perf_counter()
+            responses = list(await asyncio.gather(*[generate_with_retry(backend, prompt, semaphore, **retry_kwargs)
+                                                    for prompt in step[2]]))
+            account_step(backend, step, responses, time.perf_counter() - step_started, index, token_counts, tracer)
+            step = steps.send(responses)
+    except StopIteration as done:
+        if tracer is not None:
+            tracer.emit("question", index=index, num_documents=len(documents), wall_s=time.perf_counter() - started)
+        return done.value
+
+
+async def async_run_debates(items, backend, on_result, num_rounds: int = 3, max_active: int = 8,
+                            max_concurrency: int = 32, debate_options: dict = None, token_counts: dict = None,
+                            tracer=None, **retry_kwargs) -> int:
+    # Asyncio driver for server backends: `max_active` questions are debated at
+    # once and a global semaphore caps the requests in flight across all of them.
+    # A question whose retries run out is skipped (--resume reruns it); the
+    # number of skipped questions is returned.
+    semaphore = asyncio.Semaphore(max_concurrency)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=max_concurrency))
+    items = iter(items)
+    failures = 0
+
+    async def consume():
+        nonlocal failures
+        for item in items:
+            index, query, documents, prior = (*item, None)[:4]
+            try:
+                result = await async_multi_agent_debate(query, documents, backend, semaphore, num_rounds,
+                                                        debate_options, token_counts, tracer, index, prior,
+                                                        **retry_kwargs)
+            except Exception as e:
+                failures += 1
+                print(f"Question {index} failed: {e!r}")
+                continue
+            on_result(index, result)
+
+    await asyncio.gather(*[consume() for _ in range(max_active)])
+    return failures
+
+
+def iter_dataset(data_path: str, max_samples: int = None, skip=()):
+    # Streams (index, question, documents) without holding the dataset in memory
+    with open(data_path, "r") as f:
+        for i, line in enumerate(itertools.islice(f, max_samples)):
+            if i in skip or not line.strip():
+                continue
+            entry = json.loads(line)
+            yield i, entry["question"], [doc["text"] for doc in entry["documents"]]
+
+
+def with_prior_records(items, prior_path: str):
+    # Adds each question's record from an earlier output file (sorted by index, as
+    # every finished run leaves it) so its debate is extended instead of restarted.
+    # Questions without a record are debated from round 1.
+    with open(prior_path, "r") as f:
+        numbered = ((record.get("index", line_no), record)
+                    for line_no, record in enumerate(json.loads(line) for line in f if line.strip()))
+        prior_index, prior = -1, None
+        for item in items:
+            while prior_index < item[0]:
+                prior_index, prior = next(numbered, (float("inf"), None))
+            yield (*item, prior) if prior_index == item[0] else item
+
+
+def load_finished_indices(output_path: str) -> set:
+    # Collects the dataset indices already written to a partial output file. A torn
+    # trailing line left by a crash is cut off so new records append cleanly.
+    finished = set()
+    if not os.path.exists(output_path):
+        return finished
+    good_end = 0
+    with open(output_path, "rb") as f:
+        for line_no, line in enumerate(f):
+            if not line.endswith(b"\n"):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            # Files written before records were tagged are in dataset order
+            finished.add(record.get("index", line_no))
+            good_end += len(line)
+    if good_end != os.path.getsize(output_path):
+        with open(output_path, "r+b") as f:
+            f.truncate(good_end)
+    return finished
+
+
+def append_result(f, index: int, records: dict):
+    f.write(json.dumps({"index": index, **records}) + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def sort_results_file(output_path: str):
+    # Debates finish out of order; rewrite the file in dataset order (the viewers
+    # read it positionally), keeping the first record of any repeated index. Only
+    # line offsets are held in memory.
+    offsets = {}
+    with open(output_path, "rb") as f:
+        position = 0
+        for line_no, line in enumerate(f):
+            offsets.setdefault(json.loads(line).get("index", line_no), (position, len(line)))
+            position += len(line)
+    offsets = sorted((index, position, length) for index, (position, length) in offsets.items())
+    tmp_path = output_path + ".tmp"
+    with open(output_path, "rb") as src, open(tmp_path, "wb") as dst:
+        for _, position, length in offsets:
+            src.seek(position)
+            dst.write(src.read(length))
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(tmp_path, output_path)
+
+
+def merge_worker_outputs(output_path: str):
+    # Appends the shard files written by --workers processes to the output file;
+    # records already present are dropped by sort_results_file.
+    shard_paths = sorted(glob.glob(f"{glob.escape(output_path)}.worker*"))
+    if not shard_paths:
+        return
+    with open(output_path, "ab") as out:
+        for shard_path in shard_paths:
+            with open(shard_path, "rb") as shard:
+                shutil.copyfileobj(shard, out)
+        out.flush()
+        os.fsync(out.fileno())
+    for shard_path in shard_paths:
+        os.remove(shard_path)
+
+
+def open_response_cache(args):
+    if args.no_response_cache:
+        return None
+    return ResponseCache(args.response_cache or os.path.join(args.cache_dir, "responses.sqlite"),
+                         max_size_mb=args.response_cache_max_mb)
+
+
+def debate_options(args) -> dict:
+    return {"history_mode": args.history_mode, "aggregation": args.aggregation,
+            "unanimity_shortcut": args.unanimity_shortcut, "freeze_agents": args.freeze_agents,
+            "dedup_documents": args.dedup_documents, "replay_aggregation": bool(args.replay_aggregation),
+            "prefilter": args.prefilter, "prefilter_threshold": args.prefilter_threshold,
+            "prefilter_top_k": args.prefilter_top_k, "aggregation_group_size": args.aggregation_group_size}
+
+
+def run_questions(args, backend, items, on_result, pbar):
+    # The response cache is opened here, in the process that uses it: an SQLite
+    # connection must not cross a fork
+    tracer = Tracer(args.trace_path) if args.trace else None
+    if tracer is not None:
+        backend = TracingBackend(backend, tracer)
+    cache = open_response_cache(args)
+    if cache is not None:
+        backend = CachedBackend(backend, cache)
+    token_counts = {}
+    options = debate_options(args)
+    if args.max_prompt_tokens:
+        options["prompt_budget"] = PromptBudget(args.max_prompt_tokens, backend.count_tokens, build_agent_prompt)
+    saved_calls = 0
+    if args.dedup_documents:
+        duplicates = {}
+
+        def noting_duplicates(items):
+            for item in items:
+                index, _, documents, prior = (*item, None)[:4]
+                # Rounds taken over from an earlier run were not generated now
+                first_round = 1 + max((int(key[len("round"):]) for key in prior if key.startswith("round")),
+                                      default=0) if prior else 1
+                duplicates[index] = documents, first_round
+                yield item
+
+        def counting_saved(on_result):
+            def record(i, result):
+                nonlocal saved_calls
+                documents, first_round = duplicates.pop(i)
+                positions = duplicate_positions(documents, set(result.get("filtered_documents", [])))
+                saved_calls += saved_agent_calls(result, positions, first_round)
+                on_result(i, result)
+            return record
+
+        items = noting_duplicates(items)
+        on_result = counting_saved(on_result)
+    if args.async_debate:
+        def record(i, result):
+            on_result(i, result)
+            pbar.update(1)
+        failures = asyncio.run(async_run_debates(
+            items, backend, record, num_rounds=args.num_rounds, max_active=args.max_active,
+            max_concurrency=args.max_concurrency, debate_options=options, token_counts=token_counts,
+            tracer=tracer, timeout=args.request_timeout, max_retries=args.max_retries, backoff=args.retry_backoff))
+        if failures:
+            print(f"{failures} questions failed; rerun with --resume to retry them")
+    else:
+        for i, result in run_debates(items, backend, num_rounds=args.num_rounds, max_active=args.max_active,
+                                     debate_options=options, token_counts=token_counts, tracer=tracer):
+            on_result(i, result)
+            pbar.update(1)
+    if token_counts:
+        print(f"Prompt tokens ({args.history_mode} history): "
+              + ", ".join(f"{role}={count}" for role, count in token_counts.items())
+              + f", total={sum(token_counts.values())}")
+    if args.dedup_documents:
+        print(f"Document dedup: {saved_calls} agent calls saved")
+    if args.max_prompt_tokens:
+        print(options["prompt_budget"].stats())
+    if backend.stats():
+        print(backend.stats())
+    if cache is not None:
+        cache.close()
+    if tracer is not None:
+        tracer.close()
+
+
+def write_questions(args, backend, items, output_path: str, pbar):
+    # Each record is appended and flushed as soon as its debate finishes so a crash
+    # loses at most the questions still in flight; --resume picks up from there.
+    with open(output_path, "a") as f:
+        run_questions(args, backend, items, lambda i, result: append_result(f, i, result), pbar)
+
+
+def run_queue(args, backend, pbar):
+    # Pulls questions from the shared work queue until every job is finished or
+    # has failed. While the remaining questions are leased by other nodes this
+    # node waits, so it can pick up any whose worker died.
+    work_queue = WorkQueue(args.queue, lease_seconds=args.lease_seconds, max_attempts=args.max_attempts)
+    work_queue.start_heartbeat()
+
+    def claimed_items(claimed):
+        while True:
+            item = work_queue.claim()
+            if item is None:
+                return
+            claimed.append(item)
+            yield item
+
+    def complete(index, record):
+        done.add(index)
+        work_queue.complete(index, record)
+
+    try:
+        while work_queue.unfinished():
+            claimed, done = [], set()
+            try:
+                run_questions(args, backend, claimed_items(claimed), complete, pbar)
+            except Exception:
+                # Rerun the unfinished questions of the batch one at a time, so only
+                # the question that raises is charged a failed attempt
+                for item in [item for item in claimed if item[0] not in done]:
+                    try:
+                        run_questions(args, backend, [item], complete, pbar)
+                    except Exception as e:
+                        work_queue.fail(item[0], repr(e))
+            # The async driver leaves failed questions out of its results instead of raising
+            for item in claimed:
+                if item[0] not in done:
+                    work_queue.fail(item[0], "no record returned")
+            if not claimed:
+                time.sleep(args.queue_poll_seconds)
+    except BaseException:
+        work_queue.release()
+        raise
+    finally:
+        work_queue.close()
+
+
+def worker_main(rank: int, args, backend, queue, cpus: List[int]):
+    # Runs in a forked child: the model weights are inherited copy-on-write, and
+    # questions are pulled from the shared queue until the None sentinel arrives
+    # (or from the --queue work queue). Each worker is pinned to its own
+    # contiguous slice of cores so workers neither oversubscribe nor migrate.
+    os.sched_setaffinity(0, cpus)
+    if args.backend == "hf":
+        import torch
+        torch.set_num_threads(args.num_threads or len(cpus))
+    with tqdm(desc=f"Worker {rank}", position=rank) as pbar:
+        if args.queue:
+            run_queue(args, backend, pbar)
+        else:
+            write_questions(args, backend, iter(queue.get, None), f"{args.output_path}.worker{rank}", pbar)
+
+
+def run_workers(args, backend, items):
+    # No torch op may run in this process before forking: an initialized OpenMP
+    # pool is not fork-safe. Workers share the cores evenly.
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue(maxsize=4 * args.workers)
+    cpus = sorted(os.sched_getaffinity(0))
+    per_worker = max(1, len(cpus) // args.workers)
+    workers = [ctx.Process(target=worker_main,
+                           args=(rank, args, backend, queue,
+                                 cpus[rank * per_worker:(rank + 1) * per_worker] or cpus))
+               for rank in range(args.workers)]
+    for worker in workers:
+        worker.start()
+
+    def put(item):
+        while True:
+            try:
+                queue.put(item, timeout=5)
+                return
+            except Full:
+                if not any(worker.is_alive() for worker in workers):
+                    raise RuntimeError("All workers exited; rerun with --resume to finish the remaining questions")
+
+    # Questions are handed out one at a time so slow 12-document questions do not
+    # leave other workers idle at the end of the run
+    if not args.queue:
+        for item in items:
+            put(item)
+        for _ in workers:
+            put(None)
+    for worker in workers:
+        worker.join()
+    failed = [rank for rank, worker in enumerate(workers) if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Workers {failed} failed; rerun with --resume (or the same --queue) to finish the remaining questions")
+
+
+def parse_cpu_list(text: str) -> List[int]:
+    # "0-3,8,10-11" -> [0, 1, 2, 3, 8, 10, 11]
+    cpus = []
+    for part in text.strip().split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def configure_cpu(args):
+    # Pins the process to the requested cores (or a NUMA node's cores) so memory
+    # stays local, and sizes torch's intra-op and inter-op thread pools. Must run
+    # before the model is loaded: inter-op threads cannot be resized later.
+    import torch
+
+    if args.numa_node is not None:
+        with open(f"/sys/devices/system/node/node{args.numa_node}/cpulist") as f:
+            os.sched_setaffinity(0, parse_cpu_list(f.read()))
+    elif args.cpu_affinity:
+        os.sched_setaffinity(0, parse_cpu_list(args.cpu_affinity))
+    if args.num_interop_threads:
+        torch.set_num_interop_threads(args.num_interop_threads)
+    if args.workers <= 1:
+        # Forked workers size their own pools from their slice of the cores
+        torch.set_num_threads(args.num_threads or len(os.sched_getaffinity(0)))
+    print(f"CPU inference: {len(os.sched_getaffinity(0))} cores, {torch.get_num_threads()} intra-op threads, "
+          f"{torch.get_num_interop_threads()} inter-op threads, {args.dtype}")
+
+
+def load_hf_generator(args):
+    # torch and transformers are only needed by the in-process backend
+    import torch
+    from transformers import pipeline, AutoTokenizer, AutoModelForCausalLM, set_seed
+    from prefix_cache import PrefixCachingGenerator
+
+    hf_token = os.getenv('HF_TOKEN', None)
+    set_seed(42)
+
+    if args.device == "cpu":
+        configure_cpu(args)
+        # Loaded straight into host memory, which forked --workers share copy-on-write
+        load_cpu = lambda: AutoModelForCausalLM.from_pretrained(
+            args.model_name,
+            torch_dtype={"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}[args.dtype],
+            cache_dir=args.cache_dir,
+            token=hf_token,
+            low_cpu_mem_usage=True,
+        )
+        if args.quantize == "int8":
+            from quantization import load_int8_model
+            model = load_int8_model(args.model_name, args.cache_dir, load_cpu)
+        else:
+            model = load_cpu()
+    else:
+        model = AutoModelForCausalLM.from_pretrained(
+            args.model_name,
+            torch_dtype=torch.float16,
+            cache_dir=args.cache_dir,
+            token=hf_token,
+            device_map="auto"  # 确保这行存在
+        ).to('cuda')  # 添加这行强制使用GPU
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name, cache_dir=args.cache_dir, token=hf_token)
+    tokenizer.pad_token_id = tokenizer.eos_token_id
+    # Decoder-only models must be left-padded so batched rows generate like single prompts
+    tokenizer.padding_side = "left"
+    if args.draft_model:
+        from assisted_decoding import AssistedGenerator
+        draft_model = AutoModelForCausalLM.from_pretrained(
+            args.draft_model,
+            torch_dtype=model.dtype,
+            cache_dir=args.cache_dir,
+            token=hf_token,
+            low_cpu_mem_usage=True,
+        ).to(model.device)
+        generator = AssistedGenerator(model, tokenizer, draft_model)
+    elif args.prefix_cache:
+        generator = PrefixCachingGenerator(model, tokenizer, max_entries=args.prefix_cache_size)
+    elif args.compile:
+        from compiled_generation import CompiledGenerator
+        generator = CompiledGenerator(model, tokenizer, batch_size=args.batch_size, buckets=args.length_buckets)
+    else:
+        generator = pipeline("text-generation", model=model, tokenizer=tokenizer, trust_remote_code=True,
+                             device_map=None if args.device == "cpu" else "auto")
+    return generator
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--model_name", type=str, required=True)
@@ -138,59 +969,207 @@ def main():
     parser.add_argument("--data_path", type=str, required=True)
     parser.add_argument("--num_rounds", type=int, default=3)
     parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--batch_size", type=int, default=16,
+                        help="Max prompts per generation batch; larger steps are split across several batches")
+    parser.add_argument("--max_active", type=int, default=8,
+                        help="Number of questions whose debates are batched together")
+    parser.add_argument("--max_samples", type=int, default=50)  # 只处理前50个样本
+    parser.add_argument("--resume", action="store_true",
+                        help="Keep finished records in the output file and skip their questions")
+    parser.add_argument("--history_mode", type=str, default="full", choices=["full", "answers", "digest"],
+                        help="What agents see of each other in rounds 2+: full responses, normalized answers, "
+                             "or answers with a length-capped explanation")
+    parser.add_argument("--aggregation", type=str, default="every_round", choices=["every_round", "final"],
+                        help="Aggregate after every round, or only the round that becomes the final aggregation")
+    parser.add_argument("--aggregation_group_size", type=int, default=None,
+                        help="Aggregate rounds with more agents than this (at least 2) in groups, merged as a tree")
+    parser.add_argument("--unanimity_shortcut", action="store_true",
+                        help="Skip the aggregator call when all agents agree or all answer unknown")
+    parser.add_argument("--freeze_agents", action="store_true",
+                        help="Carry forward the response of an agent whose answer held for a round instead of rerunning it")
+    parser.add_argument("--dedup_documents", action="store_true",
+                        help="Run one agent per distinct document text (ignoring whitespace)")
+    parser.add_argument("--extend_from", type=str, default=None,
+                        help="Output file of an earlier run whose debates are continued up to --num_rounds rounds")
+    parser.add_argument("--replay_aggregation", type=str, default=None,
+                        help="Output file whose stored rounds are aggregated again; only the aggregator is run")
+    parser.add_argument("--prefilter", type=str, default=None, choices=["bm25", "overlap"],
+                        help="Drop documents that score low against the question before the debate")
+    parser.add_argument("--prefilter_threshold", type=float, default=0.1,
+                        help="Minimum prefilter score in [0, 1] (bm25 is relative to the best document)")
+    parser.add_argument("--prefilter_top_k", type=int, default=None,
+                        help="Keep at most this many of the best-scoring documents")
+    parser.add_argument("--max_prompt_tokens", type=int, default=None,
+                        help="Fit every agent prompt into this many tokens by trimming history and document")
+    parser.add_argument("--response_cache", type=str, default=None,
+                        help="SQLite file for cached LLM responses (default: <cache_dir>/responses.sqlite)")
+    parser.add_argument("--response_cache_max_mb", type=float, default=1024.0)
+    parser.add_argument("--no_response_cache", action="store_true",
+                        help="Always call the model, neither reading nor writing the response cache")
+    parser.add_argument("--prefix_cache", action="store_true",
+                        help="Reuse the KV cache of shared prompt prefixes (generates prompts one at a time)")
+    parser.add_argument("--prefix_cache_size", type=int, default=64,
+                        help="Number of prompt KV caches kept for prefix reuse")
+    parser.add_argument("--draft_model", type=str, default=None,
+                        help="Small model sharing the tokenizer that drafts tokens for assisted decoding")
+    parser.add_argument("--compile", action="store_true",
+                        help="Generate with a static KV cache and a torch.compile'd forward pass")
+    parser.add_argument("--length_buckets", type=int, nargs="+", default=[128, 256, 512, 1024, 2048, 4096],
+                        help="Prompt lengths (tokens) that --compile pads prompts up to")
+    parser.add_argument("--backend", type=str, default="hf", choices=["hf", "onnx", "openai", "stub"],
+                        help="hf: in-process transformers; onnx: ONNX Runtime on CPU; openai: OpenAI-compatible server; "
+                             "stub: deterministic test stub")
+    parser.add_argument("--server_url", type=str, default="http://localhost:8000/v1")
+    parser.add_argument("--server_model", type=str, default=None,
+                        help="Model name sent to the server (default: --model_name)")
+    parser.add_argument("--server_concurrency", type=int, default=16,
+                        help="Concurrent requests (and pooled connections) to the server")
+    parser.add_argument("--async_debate", action="store_true",
+                        help="Send every prompt of a round concurrently with asyncio (for server backends)")
+    parser.add_argument("--max_concurrency", type=int, default=32,
+                        help="Global cap on LLM requests in flight with --async_debate")
+    parser.add_argument("--request_timeout", type=float, default=300.0)
+    parser.add_argument("--max_retries", type=int, default=3)
+    parser.add_argument("--retry_backoff", type=float, default=1.0,
+                        help="Initial retry delay in seconds, doubled after each failure")
+    parser.add_argument("--trace", action="store_true",
+                        help="Write per-call and per-step timings to <output>.trace.jsonl "
+                             "(summarize with: python tracing.py summary <trace>)")
+    parser.add_argument("--device", type=str, default=None, choices=["cuda", "cpu"],
+                        help="Device for the hf backend (default: cuda, or cpu with --workers)")
+    parser.add_argument("--dtype", type=str, default=None, choices=["fp32", "bf16", "fp16"],
+                        help="Weight dtype on CPU (default: fp32); CUDA always uses fp16")
+    parser.add_argument("--quantize", type=str, default=None, choices=["int8"],
+                        help="Dynamic int8 quantization of the Linear layers (CPU), cached under --cache_dir")
+    parser.add_argument("--autocast_bf16", action="store_true",
+                        help="Run CPU generation under bf16 autocast (fp32 weights, bf16 matmuls)")
+    parser.add_argument("--num_threads", type=int, default=None,
+                        help="Intra-op threads per process on CPU (default: all cores in the affinity set, split across workers)")
+    parser.add_argument("--num_interop_threads", type=int, default=None)
+    parser.add_argument("--cpu_affinity", type=str, default=None, help="Cores to run on, e.g. 0-15,32-47")
+    parser.add_argument("--numa_node", type=int, default=None, help="Run on the cores of this NUMA node")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of forked CPU worker processes sharing the model weights")
+    parser.add_argument("--queue", type=str, default=None,
+                        help="Shared SQLite work queue; every node started with the same path pulls questions from it")
+    parser.add_argument("--lease_seconds", type=float, default=600.0,
+                        help="Lease on a claimed question, renewed while its worker is alive")
+    parser.add_argument("--max_attempts", type=int, default=3)
+    parser.add_argument("--queue_poll_seconds", type=float, default=30.0)
     args = parser.parse_args()
 
-    hf_token = os.getenv('HF_TOKEN', None)
     args.output_path = f"{args.data_path}_madam_rag_{args.model_name.split('/')[-1]}_rounds{args.num_rounds}.jsonl"
+    if args.replay_aggregation:
+        # Written next to the replayed file, which is left untouched
+        args.output_path = os.path.splitext(args.replay_aggregation)[0] + "_aggregator_replay.jsonl"
+    args.trace_path = args.output_path[:-len(".jsonl")] + ".trace.jsonl"
+    if args.trace and not args.resume and os.path.exists(args.trace_path):
+        os.remove(args.trace_path)
 
-    set_seed(42)
-
-    bnb_config = BitsAndBytesConfig(
-        load_in_4bit=True,
-        bnb_4bit_quant_type="nf4",
-        bnb_4bit_compute_dtype=torch.float16,
-        bnb_4bit_use_double_quant=True,
-    )
-
-    """model = AutoModelForCausalLM.from_pretrained(
-        args.model_name,
-        #quantization_config=bnb_config,
-        torch_dtype=torch.float16,
-        cache_dir=args.cache_dir,
-        token=hf_token,
-    )"""
-    model = AutoModelForCausalLM.from_pretrained(
-        args.model_name,
-        torch_dtype=torch.float16,
-        cache_dir=args.cache_dir,
-        token=hf_token,
-        device_map="auto"  # 确保这行存在
-    ).to('cuda')  # 添加这行强制使用GPU
+    if args.device is None:
+        # Forked workers can only share weights held in host memory
+        args.device = "cpu" if args.workers > 1 or args.quantize or args.backend == "onnx" else "cuda"
+    if args.dtype is None:
+        args.dtype = "fp32" if args.device == "cpu" else "fp16"
+    if args.workers > 1 and args.backend == "hf" and args.device != "cpu":
+        parser.error("--workers needs --device cpu")
+    if sum(map(bool, [args.draft_model, args.prefix_cache, args.compile])) > 1:
+        parser.error("--draft_model, --prefix_cache and --compile cannot be combined")
+    if args.replay_aggregation and (args.extend_from or args.queue):
+        parser.error("--replay_aggregation cannot be combined with --extend_from or --queue")
+    if args.extend_from and (args.queue or os.path.abspath(args.extend_from) == os.path.abspath(args.output_path)):
+        parser.error("--extend_from needs a different --num_rounds than the run it extends and cannot use --queue")
+    if args.aggregation_group_size is not None and args.aggregation_group_size < 2:
+        parser.error("--aggregation_group_size must be at least 2")
+    if args.async_debate and args.backend in ("hf", "onnx"):
+        # Concurrent requests would run the in-process pipeline from many threads at once
+        parser.error("--async_debate needs --backend openai or stub")
+    if args.backend == "onnx" and args.device != "cpu":
+        parser.error("--backend onnx runs on --device cpu")
+    if args.backend == "onnx" and args.workers > 1:
+        # ORT sessions and their thread pools do not survive a fork; one session uses every core instead
+        parser.error("--backend onnx cannot use --workers")
+    if args.quantize and (args.device != "cpu" or args.dtype != "fp32"):
+        parser.error("--quantize int8 needs --device cpu and --dtype fp32")
 
-    tokenizer = AutoTokenizer.from_pretrained(args.model_name, cache_dir=args.cache_dir, token=hf_token)
-    tokenizer.pad_token_id = tokenizer.eos_token_id
-    generator = pipeline("text-generation", model=model, tokenizer=tokenizer, trust_remote_code=True, device_map="auto")
+    if args.backend == "hf":
+        autocast = None
+        if args.autocast_bf16:
+            import torch
+            autocast = lambda: torch.autocast(device_type=args.device, dtype=torch.bfloat16)
+        backend = HFBackend(load_hf_generator(args), batch_size=args.batch_size, autocast=autocast)
+        # Outputs differ across devices, precisions and quantization, so each setup
+        # is cached apart; the default CUDA fp16 keeps the plain model name
+        dtype = args.dtype if args.device == "cpu" else "fp16"
+        variant = [] if (args.device, dtype) == ("cuda", "fp16") else [args.device, dtype]
+        variant += ["autocast_bf16"] * args.autocast_bf16 + [args.quantize] * bool(args.quantize)
+        backend.model_name += "".join(f":{part}" for part in variant)
+    elif args.backend == "onnx":
+        from onnx_export import load_onnx_generator
+        configure_cpu(args)
+        generator = load_onnx_generator(args.model_name, args.cache_dir, token=os.getenv('HF_TOKEN', None),
+                                        num_threads=args.num_threads or len(os.sched_getaffinity(0)))
+        backend = HFBackend(generator, batch_size=args.batch_size, model_name=f"{args.model_name}:onnx")
+    elif args.backend == "openai":
+        backend = OpenAIServerBackend(args.server_url, args.server_model or args.model_name,
+                                      api_key=os.getenv("OPENAI_API_KEY"), max_concurrency=args.server_concurrency)
+    else:
+        # Fake responses must never be served as the real model's from the response cache
+        backend = StubBackend(f"{args.model_name}:stub")
 
-    
     with open(args.data_path, "r") as f:
-        all_data = [json.loads(line.strip()) for line in f]
-        all_data = all_data[:50]  # 只处理前50个样本
+        num_samples = sum(1 for line in itertools.islice(f, args.max_samples) if line.strip())
+
+    if args.queue:
+        # Every node populates the same jobs idempotently, works until the queue
+        # is drained, and writes the merged output
+        work_queue = WorkQueue(args.queue)
+        work_queue.populate(iter_dataset(args.data_path, args.max_samples))
+        work_queue.close()
+        if args.workers > 1:
+            run_workers(args, backend, None)
+        else:
+            with tqdm(desc="Running MADAM-RAG") as pbar:
+                run_queue(args, backend, pbar)
+        work_queue = WorkQueue(args.queue)
+        print(f"Work queue: {json.dumps(work_queue.counts())}")
+        work_queue.merge(args.output_path)
+        work_queue.close()
+        backend.close()
+        return
 
-    results = []
-    for i in tqdm(range(len(all_data)), desc="Running MADAM-RAG"):
-        entry = all_data[i]
-        documents = [doc["text"] for doc in entry["documents"]]
-        result = multi_agent_debate(entry["question"], documents, generator, num_rounds=args.num_rounds)
-        results.append(result)
+    if args.resume:
+        merge_worker_outputs(args.output_path)
+        finished = load_finished_indices(args.output_path)
+    else:
+        open(args.output_path, "w").close()
+        for shard_path in glob.glob(f"{glob.escape(args.output_path)}.worker*"):
+            os.remove(shard_path)
+        finished = set()
+    items = iter_dataset(args.data_path, args.max_samples, skip=finished)
+    if args.extend_from:
+        items = with_prior_records(items, args.extend_from)
+    elif args.replay_aggregation:
+        items = (item for item in with_prior_records(items, args.replay_aggregation) if len(item) == 4)
 
-    with open(args.output_path, "w") as f:
-        for result in results:
-            f.write(json.dumps(result) + "\n")
+    if args.workers > 1:
+        run_workers(args, backend, items)
+        merge_worker_outputs(args.output_path)
+    else:
+        with tqdm(total=num_samples, initial=len([i for i in finished if i < num_samples]),
+                  desc="Running MADAM-RAG") as pbar:
+            write_questions(args, backend, items, args.output_path, pbar)
+    sort_results_file(args.output_path)
+    backend.close()
 
 if __name__ == "__main__": 
-    import torch
-    print(f"CUDA available: {torch.cuda.is_available()}")
-    print(f"GPU count: {torch.cuda.device_count()}")
-    if torch.cuda.is_available():
-        print(f"GPU name: {torch.cuda.get_device_name(0)}")
-    main() 
\ No newline at end of file
+    try:
+        import torch
+    except ImportError:  # not needed by the openai and stub backends
+        torch = None
+    if torch is not None:
+        print(f"CUDA available: {torch.cuda.is_available()}")
+        print(f"GPU count: {torch.cuda.device_count()}")
+        if torch.cuda.is_available():
+            print(f"GPU name: {torch.cuda.get_device_name(0)}")
+    main()
\ No newline at end of file
@@ -0,0 +1,162 @@
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+from collections import defaultdict
+from typing import List
+
+from backends import Backend
+
+
+class Tracer:
+    """Appends structured timing events to a JSONL trace.
+
+    Each event is a single write to a file opened with O_APPEND, so forked
+    workers can share one trace file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def emit(self, event: str, **fields):
+        line = json.dumps({"event": event, "time": time.time(), "pid": os.getpid(), **fields}) + "\n"
+        os.write(self.fd, line.encode("utf-8"))
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _cuda():
+    # Only consult torch if the backend already imported it
+    torch = sys.modules.get("torch")
+    return torch if torch is not None and torch.cuda.is_available() else None
+
+
+def reset_peak_memory():
+    torch = _cuda()
+    if torch is not None:
+        torch.cuda.reset_peak_memory_stats()
+
+
+def peak_memory_mb() -> float:
+    # Peak GPU memory since the last reset, or the process's peak RSS on CPU
+    torch = _cuda()
+    if torch is not None:
+        return torch.cuda.max_memory_allocated() / 1024 / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class TracingBackend(Backend):
+    """Records wall time, token counts, throughput, batch size and peak memory of
+    every generate call of the wrapped backend."""
+
+    def __init__(self, backend: Backend, tracer: Tracer):
+        self.backend = backend
+        self.tracer = tracer
+        self.model_name = backend.model_name
+
+    def generate(self, prompts: List[str], max_new_tokens: int = 128) -> List[str]:
+        if not prompts:
+            return []
+        reset_peak_memory()
+        started = time.perf_counter()
+        outputs = self.backend.generate(prompts, max_new_tokens)
+        wall_s = time.perf_counter() - started
+        generated_tokens = self.backend.count_tokens(outputs)
+        self.tracer.emit("llm_call", batch_size=len(prompts), wall_s=wall_s,
+                         prompt_tokens=self.backend.count_tokens(prompts), generated_tokens=generated_tokens,
+                         tokens_per_s=generated_tokens / wall_s if wall_s > 0 else None,
+                         peak_mem_mb=peak_memory_mb(), **self.backend.trace_fields())
+        return outputs
+
+    def count_tokens(self, prompts: List[str]) -> int:
+        return self.backend.count_tokens(prompts)
+
+    def stats(self) -> str:
+        return self.backend.stats()
+
+    def trace_fields(self) -> dict:
+        return self.backend.trace_fields()
+
+    def close(self):
+        self.backend.close()
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def latency_row(name: str, values: List[float], total: float = None) -> str:
+    total = sum(values) if total is None else total
+    return (f"{name:<24} {len(values):>7} {percentile(values, 50):>9.3f} {percentile(values, 90):>9.3f} "
+            f"{percentile(values, 99):>9.3f} {total:>10.1f}")
+
+
+def summarize(path: str) -> str:
+    # Steps batched with other questions share their batch's wall time: it is the
+    # latency of each of them, while totals add up each step's share of it
+    by_role = defaultdict(list)
+    by_round = defaultdict(list)
+    role_totals = defaultdict(float)
+    round_totals = defaultdict(float)
+    round_walls = defaultdict(float)
+    questions = []
+    calls = []
+    with open(path, "r") as f:
+        for line in f:
+            event = json.loads(line)
+            if event["event"] == "step":
+                share_s = event.get("share_s", event["wall_s"])
+                by_role[event["role"]].append(event["wall_s"])
+                role_totals[event["role"]] += share_s
+                # A round is its agent step plus its aggregation step
+                round_walls[(event["pid"], event["index"], event["round"])] += event["wall_s"]
+                round_totals[event["round"]] += share_s
+            elif event["event"] == "question":
+                questions.append(event["wall_s"])
+            elif event["event"] == "llm_call":
+                calls.append(event)
+    for (_, _, round_num), wall_s in round_walls.items():
+        by_round[round_num].append(wall_s)
+
+    header = f"{'':<24} {'count':>7} {'p50 (s)':>9} {'p90 (s)':>9} {'p99 (s)':>9} {'total (s)':>10}"
+    lines = ["Latency per role", header]
+    lines += [latency_row(role, values, role_totals[role]) for role, values in sorted(by_role.items())]
+    lines += ["", "Latency per round", header]
+    lines += [latency_row(f"round {round_num}", values, round_totals[round_num])
+              for round_num, values in sorted(by_round.items())]
+    lines += ["", "Latency per question", header, latency_row("question", questions)]
+    if calls:
+        wall_s = sum(call["wall_s"] for call in calls)
+        generated = sum(call["generated_tokens"] for call in calls)
+        lines += ["", "LLM calls", header, latency_row("llm_call", [call["wall_s"] for call in calls]),
+                  f"mean batch size {sum(call['batch_size'] for call in calls) / len(calls):.1f}, "
+                  f"prompt tokens {sum(call['prompt_tokens'] for call in calls)}, generated tokens {generated}, "
+                  f"{generated / wall_s if wall_s else 0:.1f} generated tokens/s, "
+                  f"peak memory {max(call['peak_mem_mb'] for call in calls):.0f} MB"]
+        drafted = sum(call.get("draft_tokens", 0) for call in calls)
+        if drafted:
+            accepted = sum(call.get("accepted_draft_tokens", 0) for call in calls)
+            lines.append(f"draft tokens {drafted}, accepted {accepted} ({accepted / drafted:.1%} acceptance rate)")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a MADAM-RAG performance trace")
+    parser.add_argument("command", choices=["summary"])
+    parser.add_argument("trace_path", type=str)
+    args = parser.parse_args()
+    print(summarize(args.trace_path))
+
+
+if __name__ == "__main__":
+    main()
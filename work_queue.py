@@ -0,0 +1,145 @@
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+
+class WorkQueue:
+    """Shared job list for multi-node MADAM-RAG runs, stored in one SQLite file.
+
+    Workers claim a question under a lease that a heartbeat keeps renewing; the
+    question of a worker that dies is handed out again once its lease expires.
+    Failed questions are retried up to `max_attempts` times. Finished records live
+    in the database, and `merge` writes them out in dataset order any number of
+    times with the same result.
+
+    SQLite locking needs a shared filesystem with working POSIX locks (e.g. NFSv4
+    or Lustre); it is not safe on filesystems that ignore them.
+    """
+
+    def __init__(self, path: str, lease_seconds: float = 600.0, max_attempts: int = 3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.conn = self._connect()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "idx INTEGER PRIMARY KEY, payload TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'pending', "
+            "worker TEXT, lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "result TEXT, error TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status)")
+        self.heartbeat = None
+        self.stop_heartbeat = threading.Event()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60.0, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA busy_timeout = 60000")
+        return conn
+
+    def populate(self, items):
+        # Safe to call from every node: existing jobs are left untouched
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.executemany("INSERT OR IGNORE INTO jobs (idx, payload) VALUES (?, ?)",
+                              ((index, json.dumps([query, documents])) for index, query, documents in items))
+        self.conn.execute("COMMIT")
+
+    def claim(self):
+        # Returns (index, query, documents) or None if nothing is claimable right now
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute(
+                "UPDATE jobs SET status = 'failed' WHERE attempts >= ? AND "
+                "(status = 'pending' OR (status = 'leased' AND lease_expires < ?))",
+                (self.max_attempts, now))
+            row = self.conn.execute(
+                "SELECT idx, payload FROM jobs WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) "
+                "ORDER BY idx LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                self.conn.execute(
+                    "UPDATE jobs SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                    "WHERE idx = ?", (self.worker_id, now + self.lease_seconds, row[0]))
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        query, documents = json.loads(row[1])
+        return row[0], query, documents
+
+    def complete(self, index: int, record: dict):
+        # A record for an already finished job (e.g. from a worker whose lease had
+        # expired) is ignored, so the first result wins
+        self.conn.execute("UPDATE jobs SET status = 'done', result = ?, lease_expires = NULL "
+                          "WHERE idx = ? AND status != 'done'", (json.dumps(record), index))
+
+    def fail(self, index: int, error: str):
+        # Hands a job that raised back for a retry; its attempt stays counted, so it
+        # is marked failed once it has used `max_attempts`
+        self.conn.execute("UPDATE jobs SET status = 'pending', worker = NULL, lease_expires = NULL, error = ? "
+                          "WHERE idx = ? AND worker = ? AND status = 'leased'", (error, index, self.worker_id))
+
+    def release(self):
+        # Hands this worker's leased jobs back when it stops without them failing,
+        # returning the attempts they were charged
+        self.conn.execute("UPDATE jobs SET status = 'pending', worker = NULL, lease_expires = NULL, "
+                          "attempts = attempts - 1 WHERE worker = ? AND status = 'leased'", (self.worker_id,))
+
+    def start_heartbeat(self):
+        def renew():
+            conn = self._connect()
+            while not self.stop_heartbeat.wait(self.lease_seconds / 3):
+                conn.execute("UPDATE jobs SET lease_expires = ? WHERE worker = ? AND status = 'leased'",
+                             (time.time() + self.lease_seconds, self.worker_id))
+            conn.close()
+        self.heartbeat = threading.Thread(target=renew, daemon=True)
+        self.heartbeat.start()
+
+    def counts(self) -> dict:
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def unfinished(self) -> int:
+        counts = self.counts()
+        return counts.get("pending", 0) + counts.get("leased", 0)
+
+    def merge(self, output_path: str):
+        tmp_path = f"{output_path}.{self.worker_id.replace(':', '_')}.tmp"
+        with open(tmp_path, "w") as f:
+            for index, result in self.conn.execute(
+                    "SELECT idx, result FROM jobs WHERE status = 'done' ORDER BY idx"):
+                f.write(json.dumps({"index": index, **json.loads(result)}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, output_path)
+
+    def close(self):
+        self.stop_heartbeat.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+        self.conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or merge a MADAM-RAG work queue")
+    parser.add_argument("command", choices=["status", "merge"])
+    parser.add_argument("queue_path", type=str)
+    parser.add_argument("--output_path", type=str, help="Output file for merge")
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.queue_path)
+    if args.command == "status":
+        print(json.dumps(queue.counts()))
+    else:
+        if not args.output_path:
+            parser.error("merge requires --output_path")
+        queue.merge(args.output_path)
+    queue.close()
+
+
+if __name__ == "__main__":
+    main()